@@ -0,0 +1,51 @@
+"""
+modules that are only imported when they are first used.
+
+skimage, scipy, cliquematch and matplotlib take seconds to import,
+and the GUI needs none of them to show its window: the registries
+(EXTRACTOR_MAP, ALIGNER_MAP, ...) only need the class names.
+
+    sktrans = lazy_import("skimage.transform")
+    ...
+    sktrans.warp(...)   # skimage.transform is imported here
+
+preload imports everything that is still pending, e.g. in the
+background once the window is up.
+"""
+__all__ = ("lazy_import", "preload")
+
+import sys
+import types
+import importlib
+
+_PENDING = set()
+
+
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        _PENDING.discard(self.__name__)
+        # later lookups find the attributes without coming here
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    _PENDING.add(name)
+    return _LazyModule(name)
+
+
+def preload(names=None):
+    """
+    import names (default: every module still pending), return the time taken
+    """
+    import time
+
+    start = time.perf_counter()
+    for name in sorted(_PENDING if names is None else names):
+        importlib.import_module(name)
+        _PENDING.discard(name)
+    return time.perf_counter() - start
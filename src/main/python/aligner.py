@@ -3,10 +3,11 @@ from extractor import EXTRACTOR_MAP
 from corresponder import CliqueMatcher
 
 import warnings
-import skimage.transform as sktrans
 import numpy as np
-import cliquematch
-import time
+from _lazy import lazy_import
+
+sktrans = lazy_import("skimage.transform")
+ndi = lazy_import("scipy.ndimage")
 
 # REMEMBER skimage warp IS WHACK
 # REMEMBER MAP_FUNC IS FROM K TO Q !!!
@@ -19,6 +20,115 @@ def centerify(x):
     return cent, x - cent
 
 
+def _affine_params(map_func):
+    # the 3x3 matrix of a rigid/affine map_func, or None
+    params = getattr(map_func, "params", None)
+    if params is None or np.shape(params) != (3, 3):
+        return None
+    if not np.allclose(params[2], (0, 0, 1)):
+        return None
+    return params
+
+
+def _interp_rows(coarse, at, n):
+    # linear interpolation along axis 0, from the rows at `at` to range(n)
+    i = np.clip(np.searchsorted(at, np.arange(n), side="right") - 1, 0, len(at) - 2)
+    w = (np.arange(n, dtype=np.float32) - at[i]) / (at[i + 1] - at[i])
+    w = w.reshape((-1,) + (1,) * (coarse.ndim - 1))
+    return coarse[i] * (1 - w) + coarse[i + 1] * w
+
+
+# largest error, in pixels of img, that the interpolated coordinates
+# of warp_image may have; the grid is refined until it holds
+_GRID_TOLERANCE = 0.02
+
+
+def _map_grid(map_func, at_r, at_c):
+    # map_func at every (row, col) of the grid, as (len(at_r), len(at_c), 2) x, y
+    cc, rr = np.meshgrid(at_c, at_r)
+    xy = map_func(np.column_stack((cc.ravel(), rr.ravel())).astype(np.float64))
+    return np.asarray(xy, dtype=np.float64).reshape(len(at_r), len(at_c), 2)
+
+
+def _coarse_coords(map_func, out_shape, grid_step, tolerance=_GRID_TOLERANCE):
+    """
+    (row, col) in Q for every output pixel, with map_func
+    evaluated every grid_step pixels and interpolated in between.
+
+    the step is halved until map_func at the centre of every cell is
+    within tolerance of the interpolation, which is where the bilinear
+    error of a smooth map is largest; at step 1 the coordinates are exact.
+    """
+    rows, cols = out_shape
+    while True:
+        at_r = np.unique(np.append(np.arange(0, rows, grid_step), rows - 1))
+        at_c = np.unique(np.append(np.arange(0, cols, grid_step), cols - 1))
+        if len(at_r) < 2 or len(at_c) < 2:
+            return None
+        xy = _map_grid(map_func, at_r, at_c)
+        if grid_step <= 1:
+            break
+        centres = _map_grid(
+            map_func, (at_r[:-1] + at_r[1:]) / 2, (at_c[:-1] + at_c[1:]) / 2
+        )
+        interp = (xy[:-1, :-1] + xy[1:, :-1] + xy[:-1, 1:] + xy[1:, 1:]) / 4
+        if np.abs(centres - interp).max() <= tolerance:
+            break
+        grid_step //= 2
+
+    xy = xy.astype(np.float32)
+    # first along the rows (small), then along the columns (full size)
+    xy = _interp_rows(xy, at_r.astype(np.float32), rows)
+    xy = _interp_rows(xy.transpose(1, 0, 2), at_c.astype(np.float32), cols)
+    return xy[..., 1].T, xy[..., 0].T
+
+
+def warp_image(img, map_func, out_shape, order=1, cval=1, grid_step=16):
+    """
+    float32 warp of img into out_shape, map_func going
+    from output (x, y) to img (x, y) like sktrans.warp's inverse_map.
+
+    rigid/affine maps go straight to ndimage.affine_transform,
+    polynomial maps are evaluated on a grid_step grid, refined until the
+    interpolated coordinates are within _GRID_TOLERANCE pixels (so the
+    pixels are within that many times the local gradient of img).
+    """
+    img = np.asarray(img, dtype=np.float32)
+    params = _affine_params(map_func)
+    if params is not None:
+        # (x, y) is (col, row), so swap both axes of the matrix
+        return ndi.affine_transform(
+            img,
+            matrix=params[[1, 0]][:, [1, 0]],
+            offset=params[[1, 0], 2],
+            output_shape=tuple(out_shape),
+            output=np.float32,
+            order=order,
+            mode="constant",
+            cval=cval,
+        )
+    if isinstance(map_func, sktrans.PolynomialTransform):
+        coords = _coarse_coords(map_func, out_shape, grid_step)
+        if coords is not None:
+            return ndi.map_coordinates(
+                img,
+                coords,
+                output=np.float32,
+                order=order,
+                mode="constant",
+                cval=cval,
+            )
+    out = sktrans.warp(
+        img,
+        inverse_map=map_func,
+        output_shape=out_shape,
+        order=order,
+        mode="constant",
+        cval=cval,
+    )
+    return np.asarray(out, dtype=np.float32)
+
+
 class AlignFunction:
     _extname_ = "<none>"
 
@@ -36,16 +146,10 @@ class AlignFunction:
         return self._get_mapping(Q, K, corr, *args, **params)
 
     def align_Q_to_K(self, Q, K, corr, *args, **params):
-        map_func = params.get(
-            "map_func", self._get_mapping(Q, K, corr, *args, **params)
-        )
-        return sktrans.warp(
-            Q.img,
-            inverse_map=map_func,
-            output_shape=K.img.shape,
-            mode="constant",
-            cval=1,
-        )
+        map_func = params.get("map_func")
+        if map_func is None:
+            map_func = self._get_mapping(Q, K, corr, *args, **params)
+        return warp_image(Q.img, map_func, K.shape, order=1, cval=1)
 
 
 class DummyMapping(AlignFunction):
@@ -137,12 +241,19 @@ def get_alignment_function(Q, K, corr, method_name="kabsch"):
 
 
 def get_QK_correspondence(
-    Q: ImageDesc, K: ImageDesc, extractor_name: str = "KAZE", epsilon: float = 0.01
+    Q: ImageDesc,
+    K: ImageDesc,
+    extractor_name: str = "KAZE",
+    epsilon: float = 0.01,
+    store=None,
 ):
+    # avoid a circular import, runner imports this module
+    from runner import extract_points
+
     extractor = EXTRACTOR_MAP[extractor_name]()
     epsilon = max(0, epsilon)
-    Q.points = extractor(Q.img)
-    K.points = extractor(K.img)
+    extract_points(extractor, Q, store=store)
+    extract_points(extractor, K, store=store)
 
     matcher = CliqueMatcher(epsilon=epsilon, use_dfs=False)
     return matcher(Q, K)
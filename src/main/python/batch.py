@@ -0,0 +1,458 @@
+"""
+headless comparison of one Q against a gallery of K prints.
+
+the interest points of Q are extracted once in the parent process,
+shipped to every worker when the pool starts, and the K prints are
+spread over the pool. results stream back as each K finishes.
+
+    python batch.py Q.tiff K1.tiff K2.tiff ... --workers 8
+
+with --prescreen N, every K is first matched against Q at a coarse
+scale (see pyramid.prescreen), and only the N best go on to the full
+comparison.
+"""
+__all__ = ("compare_many", "rank_results", "main")
+
+import os
+import sys
+import argparse
+import functools
+import multiprocessing
+
+from imdesc import ImageDesc
+from extractor import EXTRACTOR_MAP
+from corresponder import CORRESPONDER_MAP
+from scorer import SCORINGMETHOD_MAP, score_all, needs_of, set_spectrum_cache
+import refdist
+from kpstore import KeypointStore, default_store
+from tracing import default_tracer
+from runner import load_image, extract_points, align_pair, TextProgress
+from pyramid import prescreen as _prescreen_pair
+
+# per-process state, filled in by _init_worker
+_STATE = {}
+
+
+def _init_worker(
+    q,
+    etor_name,
+    aligner_name,
+    metrics,
+    epsilon,
+    alpha,
+    store,
+    cder_params,
+    listener=None,
+):
+    _STATE["q"] = q
+    _STATE["listener"] = listener
+    _STATE["cder_params"] = cder_params
+    _STATE["store"] = store
+    _STATE["extractor"] = EXTRACTOR_MAP[etor_name]()
+    _STATE["params"] = dict(
+        etor_name=etor_name,
+        aligner_name=aligner_name,
+        metrics=metrics,
+        epsilon=epsilon,
+        alpha=alpha,
+    )
+
+
+def _init_pool_worker(*args):
+    # every K is scored once, its spectrum would only take up memory
+    set_spectrum_cache(0)
+    _init_worker(*args)
+
+
+def _without_pixels(img_desc):
+    # the points and descriptors of img_desc, without copying them
+    light = ImageDesc(None, img_desc.name, img_desc.filename, img_desc.key)
+    light.points = img_desc.points
+    light.descriptors = img_desc.descriptors
+    return light
+
+
+def _new_result(k_path, p, cder_params):
+    return dict(
+        k_path=k_path,
+        success=False,
+        message="",
+        extractor=p["etor_name"],
+        alignment=p["aligner_name"],
+        corresponder=cder_params.get("cder_name", "clique2"),
+        metric=p["metrics"][0],
+        eps1=p["epsilon"],
+        alpha=p["alpha"],
+    )
+
+
+def _compare_one(k_path):
+    q = _STATE["q"]
+    p = _STATE["params"]
+    store = _STATE["store"]
+    res = _new_result(k_path, p, _STATE["cder_params"])
+    name = os.path.splitext(os.path.basename(k_path))[0]
+    try:
+        with default_tracer(
+            "batch-" + name, listener=_STATE["listener"], k_path=k_path, **p
+        ) as tracer:
+            k = load_image(k_path, is_k=True, store=store, tracer=tracer)
+            extract_points(
+                _STATE["extractor"],
+                k,
+                store=store,
+                descriptors=_STATE["cder_params"].get("top_m") is not None,
+                tracer=tracer,
+            )
+            cder, corr, map_func = align_pair(
+                q,
+                k,
+                p["aligner_name"],
+                p["epsilon"],
+                p["alpha"],
+                needs=needs_of(p["metrics"]),
+                tracer=tracer,
+                **_STATE["cder_params"]
+            )
+            with tracer.span("score", metrics=p["metrics"]):
+                scores = score_all(q, k, corr, map_func, metrics=p["metrics"])
+            # q stays alive for the next K, its warp into this K does not
+            q.forget("aligned_img")
+    except Exception as e:
+        res["message"] = str(e)
+        return res
+
+    res.update(
+        success=True,
+        score=scores[p["metrics"][0]],
+        scores=scores,
+        q_pts=len(q.points),
+        k_pts=len(k.points),
+        clique_size=corr["size"],
+        optimal=corr.get("optimal"),
+        time=corr.get("time"),
+    )
+    return res
+
+
+def _prescreen_one(k_path, q_path, etor_name, epsilon, alpha, store, cder_params):
+    try:
+        return k_path, _prescreen_pair(
+            q_path, k_path, etor_name, epsilon, alpha, store=store, **cder_params
+        )
+    except Exception:
+        # the full comparison reports what went wrong
+        return k_path, None
+
+
+def _prescreen(
+    q_path, k_paths, keep, etor_name, epsilon, alpha, store, cder_params, workers
+):
+    """
+    coarse clique fraction of every K, {k_path: fraction or None},
+    and the set of K paths that go on to the full comparison:
+    the keep best, and those whose prescreen failed
+    """
+    # the clique matcher options that make sense at any scale
+    cder_params = {
+        x: cder_params[x]
+        for x in ("theta_range", "max_translation", "time_budget")
+        if cder_params.get(x) is not None
+    }
+    screen = functools.partial(
+        _prescreen_one,
+        q_path=q_path,
+        etor_name=etor_name,
+        epsilon=epsilon,
+        alpha=alpha,
+        store=store,
+        cder_params=cder_params,
+    )
+    if workers == 1:
+        fractions = dict(map(screen, k_paths))
+    else:
+        with multiprocessing.Pool(processes=workers) as pool:
+            fractions = dict(pool.imap_unordered(screen, k_paths))
+
+    screened = [x for x in k_paths if fractions[x] is not None]
+    screened.sort(key=lambda x: fractions[x], reverse=True)
+    # a failed prescreen goes on, its comparison fails with a message
+    kept = set(screened[:keep]) | {x for x in k_paths if fractions[x] is None}
+    return fractions, kept
+
+
+def _compare_all(k_paths, initargs, workers, listener):
+    if workers == 1:
+        _init_worker(*initargs, listener=listener)
+        for k_path in k_paths:
+            yield _compare_one(k_path)
+        return
+
+    pool = multiprocessing.Pool(
+        processes=workers, initializer=_init_pool_worker, initargs=initargs
+    )
+    try:
+        for res in pool.imap_unordered(_compare_one, k_paths):
+            yield res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def compare_many(
+    q_path,
+    k_paths,
+    extractor,
+    aligner,
+    scorer,
+    epsilon,
+    alpha,
+    workers=None,
+    store=None,
+    q_desc=None,
+    listener=None,
+    prescreen=None,
+    **cder_params
+):
+    """
+    compare Q against every path in k_paths,
+    yielding one result dict per K as soon as it is done.
+
+    the order of the yielded results is the order of completion,
+    use rank_results to sort them by score.
+
+    scorer is a metric name, a list of names, or "all":
+    every result has the scores of all of them in "scores",
+    computed in one pass, and the first one in "score".
+
+    store is an optional KeypointStore, shared by all the workers.
+    q_desc is an already loaded Q with its points, to skip loading it again.
+    listener gets the progress events of every stage (see tracing.py),
+    only when the comparisons run in this process (workers=1).
+    prescreen=N matches every K at a coarse scale first, and only compares
+    the N with the highest coarse clique fraction; the others are yielded
+    as failed results, with their "prescreen" fraction like the rest.
+    any other keyword arguments go to align_pair, e.g. cder_name="ransac",
+    or to the clique matcher, e.g. theta_range=(-30, 30),
+    max_translation, top_m or time_budget.
+    """
+    if store is None:
+        store = default_store()
+    want_desc = cder_params.get("top_m") is not None
+    q = q_desc
+    if q is None or (want_desc and q.descriptors is None):
+        q = load_image(q_path, is_k=False, store=store)
+        extract_points(
+            EXTRACTOR_MAP[extractor](), q, store=store, descriptors=want_desc
+        )
+    if scorer == "all":
+        scorer = list(SCORINGMETHOD_MAP.keys())
+    elif isinstance(scorer, str):
+        scorer = [scorer]
+    # q goes to every worker without its pixels, unless an image metric
+    # warps them: those keep the float32 pixels the GUI and the reference
+    # distributions use, a compacted q would score quantized pixels
+    if "aligned_img" not in needs_of(scorer):
+        q = _without_pixels(q)
+    initargs = (
+        q,
+        extractor,
+        aligner,
+        list(scorer),
+        float(epsilon),
+        float(alpha),
+        store,
+        cder_params,
+    )
+
+    k_paths = list(k_paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(k_paths)))
+
+    fractions = {}
+    if prescreen is not None and prescreen < len(k_paths):
+        fractions, kept = _prescreen(
+            q_path,
+            k_paths,
+            prescreen,
+            extractor,
+            float(epsilon),
+            float(alpha),
+            store,
+            cder_params,
+            workers,
+        )
+        p = dict(
+            etor_name=extractor,
+            aligner_name=aligner,
+            metrics=scorer,
+            epsilon=float(epsilon),
+            alpha=float(alpha),
+        )
+        for k_path in k_paths:
+            if k_path not in kept:
+                res = _new_result(k_path, p, cder_params)
+                res["message"] = "dropped by the prescreen"
+                res["prescreen"] = fractions[k_path]
+                yield res
+        k_paths = [x for x in k_paths if x in kept]
+        workers = max(1, min(workers, len(k_paths)))
+
+    for res in _compare_all(k_paths, initargs, workers, listener):
+        if fractions:
+            res["prescreen"] = fractions[res["k_path"]]
+        yield res
+
+
+def rank_results(results):
+    # every metric in SCORINGMETHOD_MAP is "higher is more similar",
+    # failed comparisons go to the bottom
+    ok = [x for x in results if x["success"]]
+    failed = [x for x in results if not x["success"]]
+    ok.sort(key=lambda x: x["score"], reverse=True)
+    for i, x in enumerate(ok):
+        x["rank"] = i + 1
+    return ok + failed
+
+
+def main(argv=None):
+    from aligner import ALIGNER_MAP
+
+    parser = argparse.ArgumentParser(
+        description="compare a Q print against a gallery of K prints"
+    )
+    parser.add_argument("q_path", help="crime scene print (Q)")
+    parser.add_argument("k_paths", nargs="+", help="test impressions (K)")
+    parser.add_argument(
+        "--extractor", default="ORB", choices=sorted(EXTRACTOR_MAP.keys())
+    )
+    parser.add_argument("--aligner", default="kabsch", choices=list(ALIGNER_MAP.keys()))
+    parser.add_argument(
+        "--scorer",
+        nargs="+",
+        default=["clique_fraction"],
+        choices=list(SCORINGMETHOD_MAP.keys()) + ["all"],
+        help="one or more metrics, ranked by the first, or all of them",
+    )
+    parser.add_argument("--epsilon", type=float, default=0.5)
+    parser.add_argument("--alpha", type=float, default=5.0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--cache", default=None, help="directory for the keypoint store"
+    )
+    parser.add_argument(
+        "--cache-mb", type=float, default=1024, help="size limit of the store"
+    )
+    parser.add_argument(
+        "--max-rotation",
+        type=float,
+        default=None,
+        help="only match impressions rotated by at most this many degrees",
+    )
+    parser.add_argument(
+        "--max-translation",
+        type=float,
+        default=None,
+        help="only match impressions shifted by at most this many pixels",
+    )
+    parser.add_argument(
+        "--top-m",
+        type=int,
+        default=None,
+        help="only consider the M best descriptor matches of each Q point",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=None,
+        help="seconds allowed for each clique search, keep the best so far",
+    )
+    parser.add_argument(
+        "--corresponder", default="clique2", choices=list(CORRESPONDER_MAP.keys())
+    )
+    parser.add_argument(
+        "--prescreen",
+        type=int,
+        default=None,
+        metavar="N",
+        help="match every K at a coarse scale first, fully compare only the N best",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print every stage of the comparisons (with --workers 1)",
+    )
+    parser.add_argument(
+        "--refdist",
+        default=None,
+        help="reference distributions (refdist.bin), to add percentiles and SLRs",
+    )
+    args = parser.parse_args(argv)
+    cder_params = dict(cder_name=args.corresponder)
+    if args.time_budget is not None:
+        cder_params["time_budget"] = args.time_budget
+    if args.top_m is not None:
+        cder_params["top_m"] = args.top_m
+    if args.max_rotation is not None:
+        cder_params["theta_range"] = (-args.max_rotation, args.max_rotation)
+    if args.max_translation is not None:
+        cder_params["max_translation"] = args.max_translation
+    metrics = args.scorer
+    if "all" in metrics:
+        metrics = list(SCORINGMETHOD_MAP.keys())
+    store = None
+    if args.cache:
+        store = KeypointStore(args.cache, max_bytes=args.cache_mb * (1 << 20))
+
+    results = []
+    for i, res in enumerate(
+        compare_many(
+            args.q_path,
+            args.k_paths,
+            extractor=args.extractor,
+            aligner=args.aligner,
+            scorer=metrics,
+            epsilon=args.epsilon,
+            alpha=args.alpha,
+            workers=args.workers,
+            store=store,
+            listener=TextProgress() if args.verbose else None,
+            prescreen=args.prescreen,
+            **cder_params
+        )
+    ):
+        results.append(res)
+        status = "%.4f" % res["score"] if res["success"] else "failed"
+        print(
+            "[%d/%d] %s %s" % (i + 1, len(args.k_paths), res["k_path"], status),
+            file=sys.stderr,
+        )
+
+    ref, ref_name = None, None
+    if args.refdist:
+        ref = refdist.load(args.refdist)
+        ref_name = "{}-{}-{}".format(args.extractor, args.aligner, metrics[0])
+        if ref_name not in ref:
+            print("no reference distribution for %s" % ref_name, file=sys.stderr)
+            ref = None
+    extra = ["nonmatch_pct", "slr"] if ref is not None else []
+
+    print("\t".join(["rank"] + metrics + extra + ["k_path"]))
+    for res in rank_results(results):
+        if res["success"]:
+            cols = ["%.6f" % res["scores"][x] for x in metrics]
+            if ref is not None:
+                cal = ref.lookup(ref_name, res["score"])
+                cols += ["%.2f" % cal["nonmatches_percentile"], "%.4g" % cal["slr"]]
+            print("\t".join(["%d" % res["rank"]] + cols + [res["k_path"]]))
+        else:
+            dashes = ["-"] * (len(metrics) + len(extra))
+            print("\t".join(["-"] + dashes + [res["k_path"], res["message"]]))
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
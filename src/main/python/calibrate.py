@@ -0,0 +1,209 @@
+"""
+regenerate the reference score distributions under resources/base.
+
+there is one {extractor}-{aligner}-{metric}.npy file per combination,
+a pickled dict with the scores of mated pairs ("matches") and of
+non-mated pairs ("nonmatches"), and a refdist.bin with all of them
+(see refdist.py). this rebuilds all of them from a
+labeled folder of pairs, which has a pairs.csv with the columns
+
+    q, k, mated
+
+where q and k are paths relative to the folder and mated is 1 or 0.
+
+the scores come from sweep.py, so every stage of a pair is shared
+between the combinations, and the pairs are spread over a process pool.
+the sweep's CSV file is the checkpoint: a run that crashed resumes
+with the pairs that were not done yet.
+
+    python calibrate.py FOLDER ../resources/base --workers 16
+"""
+__all__ = ("read_labeled", "collect", "write_distributions", "calibrate", "main")
+
+import os
+import sys
+import csv
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+
+from extractor import EXTRACTOR_MAP
+from aligner import ALIGNER_MAP
+import refdist
+from kpstore import KeypointStore
+from sweep import make_grid, sweep, read_pairs
+
+_TRUE = ("1", "true", "yes", "y", "mated", "match")
+
+
+def read_labeled(folder, manifest="pairs.csv"):
+    """
+    (q_path, k_path) pairs and a dict of (q_path, k_path) -> mated
+    """
+    pairs, labels = [], {}
+    for row in read_pairs(os.path.join(folder, manifest)):
+        q = os.path.join(folder, row["q"])
+        k = os.path.join(folder, row["k"])
+        pairs.append((q, k))
+        labels[(q, k)] = row["mated"].strip().lower() in _TRUE
+    return pairs, labels
+
+
+def _in_grid(row, grid):
+    try:
+        return (
+            row["extractor"] in grid["extractors"]
+            and float(row["eps1"]) in grid["epsilons"]
+            and float(row["alpha"]) in grid["alphas"]
+            and row["alignment"] in grid["aligners"]
+            and row["metric"] in grid["metrics"]
+        )
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def collect(scores_path, labels, grid=None):
+    """
+    {(extractor, aligner, metric): (matches, nonmatches)}
+    from the rows of a sweep CSV file.
+
+    the file can hold rows of earlier runs with other parameters,
+    only the rows of grid (see sweep.make_grid) are kept, if given.
+    """
+    out = {}
+    with open(scores_path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            mated = labels.get((row["q_path"], row["k_path"]))
+            if mated is None or row["success"] != "True":
+                continue
+            if grid is not None and not _in_grid(row, grid):
+                continue
+            key = (row["extractor"], row["alignment"], row["metric"])
+            both = out.setdefault(key, ([], []))
+            both[0 if mated else 1].append(float(row["score"]))
+    return out
+
+
+def _save_npy(path, obj):
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, obj, allow_pickle=True)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_distributions(dists, out_dir):
+    """
+    one {extractor}-{aligner}-{metric}.npy per combination,
+    and all of them packed into one refdist.bin,
+    which presenter.draw_kde reads first
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    for (etor, aligner, metric), (matches, nonmatches) in sorted(dists.items()):
+        fname = os.path.join(out_dir, "{}-{}-{}.npy".format(etor, aligner, metric))
+        _save_npy(
+            fname,
+            dict(
+                matches=np.array(matches, dtype=np.float64),
+                nonmatches=np.array(nonmatches, dtype=np.float64),
+            ),
+        )
+        written.append(fname)
+    if dists:
+        fname = os.path.join(out_dir, refdist.FILENAME)
+        refdist.write(fname, dists)
+        written.append(fname)
+    return written
+
+
+def calibrate(
+    folder,
+    out_dir,
+    epsilon=0.5,
+    alpha=5.0,
+    extractors=None,
+    aligners=None,
+    metrics="all",
+    scores_path=None,
+    workers=None,
+    store=None,
+    progress=None,
+    **cder_params
+):
+    """
+    score every labeled pair in folder for every combination
+    (by default all of EXTRACTOR_MAP, ALIGNER_MAP and SCORINGMETHOD_MAP),
+    and write the distributions to out_dir.
+
+    scores_path is the checkpoint, by default FOLDER/scores.csv.
+    progress, if given, is called with (pairs done, pairs total).
+    """
+    if extractors is None:
+        extractors = sorted(EXTRACTOR_MAP.keys())
+    if aligners is None:
+        aligners = list(ALIGNER_MAP.keys())
+    if scores_path is None:
+        scores_path = os.path.join(folder, "scores.csv")
+    pairs, labels = read_labeled(folder)
+    grid = make_grid(extractors, [epsilon], [alpha], aligners, metrics)
+
+    for i, _ in enumerate(
+        sweep(pairs, grid, scores_path, workers=workers, store=store, **cder_params)
+    ):
+        if progress is not None:
+            progress(i + 1, len(pairs))
+    return write_distributions(collect(scores_path, labels, grid), out_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="regenerate the reference score distributions"
+    )
+    parser.add_argument("folder", help="folder with pairs.csv (q, k, mated)")
+    parser.add_argument("out_dir", help="where the .npy files go")
+    parser.add_argument("--epsilon", type=float, default=0.5)
+    parser.add_argument("--alpha", type=float, default=5.0)
+    parser.add_argument(
+        "--scores", default=None, help="checkpoint CSV, default FOLDER/scores.csv"
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--cache", default=None, help="directory for the keypoint store"
+    )
+    parser.add_argument(
+        "--cache-mb", type=float, default=1024, help="size limit of the store"
+    )
+    args = parser.parse_args(argv)
+
+    store = None
+    if args.cache:
+        store = KeypointStore(args.cache, max_bytes=args.cache_mb * (1 << 20))
+
+    def progress(done, total):
+        # pairs that were done before a restart are not counted
+        print("[%d/%d] pairs scored" % (done, total), file=sys.stderr)
+
+    written = calibrate(
+        args.folder,
+        args.out_dir,
+        epsilon=args.epsilon,
+        alpha=args.alpha,
+        scores_path=args.scores,
+        workers=args.workers,
+        store=store,
+        progress=progress,
+    )
+    print("wrote %d files to %s" % (len(written), args.out_dir))
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -3,12 +3,382 @@ import warnings
 import time
 import numpy as np
 from collections import UserDict
-import rtree
+from _lazy import lazy_import
+from tracing import NULL as _NULL_TRACER
 
-import cliquematch
+spatial = lazy_import("scipy.spatial")
+cliquematch = lazy_import("cliquematch")
 
 warnings.filterwarnings(action="ignore", message=".*Euclidean.*", module="cliquematch")
 
+
+# vectorized rounds before thin_indices finishes with the sequential loop
+_THIN_ROUNDS = 16
+
+
+def thin_indices(pts, r):
+    """
+    greedy thinning: walk the points in order,
+    and drop every point within distance r of a point already kept.
+
+    all the close pairs are found at once with a KD-tree,
+    and the greedy "first point wins" rule is resolved in rounds:
+    a point is kept once none of its earlier neighbours can still be kept,
+    and dropped as soon as one of them is kept.
+    every round is vectorized, and the lowest undecided point
+    is always decided, so this matches the sequential loop exactly.
+
+    a chain of close points is only decided one link per round, so after
+    _THIN_ROUNDS rounds the undecided points are walked in order, one
+    python step each: the worst case, one long chain, costs
+    O(n + pairs) in that loop instead of n rounds of O(n + pairs) each.
+    """
+    n = len(pts)
+    if r <= 0.0 or n < 2:
+        return np.arange(n)
+    pairs = spatial.cKDTree(pts).query_pairs(r, output_type="ndarray")
+    if len(pairs) == 0:
+        return np.arange(n)
+    # query_pairs gives i < j, so i is the earlier point
+    first, second = pairs[:, 0], pairs[:, 1]
+
+    UNDECIDED, KEPT, DROPPED = 0, 1, 2
+    state = np.zeros(n, dtype=np.int8)
+    state[np.setdiff1d(np.arange(n), second)] = KEPT
+    for _ in range(_THIN_ROUNDS):
+        pending = state == UNDECIDED
+        if not np.any(pending):
+            return np.flatnonzero(state == KEPT)
+        has_kept = np.bincount(second[state[first] == KEPT], minlength=n) > 0
+        has_open = np.bincount(second[state[first] == UNDECIDED], minlength=n) > 0
+        state[pending & has_kept] = DROPPED
+        state[pending & ~has_kept & ~has_open] = KEPT
+
+    # earlier neighbours of every point, grouped by point
+    order = np.argsort(second, kind="stable")
+    earlier = first[order].tolist()
+    starts = np.searchsorted(second[order], np.arange(n + 1)).tolist()
+    kept = (state == KEPT).tolist()
+    for i in np.flatnonzero(state == UNDECIDED).tolist():
+        kept[i] = not any(kept[j] for j in earlier[starts[i] : starts[i + 1]])
+    return np.flatnonzero(kept)
+
+
+def thin_points(pts, r):
+    return pts[thin_indices(pts, r)]
+
+
+def _wrap_angle(x):
+    # into [-pi, pi)
+    return (x + np.pi) % (2 * np.pi) - np.pi
+
+
+def _ordered_pairs(pts):
+    """
+    every ordered pair (i, j), i != j, of the points,
+    with the length and direction of pts[j] - pts[i]
+    """
+    n = len(pts)
+    i, j = np.nonzero(~np.eye(n, dtype=np.bool_))
+    diff = pts[j] - pts[i]
+    return i, j, np.hypot(diff[:, 0], diff[:, 1]), np.arctan2(diff[:, 1], diff[:, 0])
+
+
+def _motion_mask(theta, q1, k1, theta_range, max_translation):
+    """
+    which candidate edges are consistent with the motion limits,
+    theta is the rotation taking the K pair onto the Q pair,
+    q1 and k1 the (x, y) of the first vertex of each edge
+    """
+    keep = np.ones(len(theta), dtype=np.bool_)
+    if theta_range is not None:
+        t_lo, t_hi = np.radians(theta_range[0]), np.radians(theta_range[1])
+        t_mid, t_half = (t_lo + t_hi) / 2, (t_hi - t_lo) / 2
+        keep &= np.abs(_wrap_angle(theta - t_mid)) <= t_half
+    if max_translation is not None:
+        cos, sin = np.cos(theta), np.sin(theta)
+        tx = q1[:, 0] - (cos * k1[:, 0] - sin * k1[:, 1])
+        ty = q1[:, 1] - (sin * k1[:, 0] + cos * k1[:, 1])
+        keep &= np.hypot(tx, ty) <= max_translation
+    return keep
+
+
+def limited_edges(
+    Q_pts,
+    K_pts,
+    epsilon,
+    theta_range=None,
+    max_translation=None,
+    chunk_size=1 << 22,
+):
+    """
+    edges of the A2AGraph between Q_pts and K_pts,
+    numbered the same way as cliquematch.A2AGraph (vertex i*|K| + j + 1),
+    but only the ones consistent with a limited rigid motion.
+
+    theta_range is (low, high) in degrees: the rotation that takes the
+    K pair onto the Q pair, measured in (x, y) = (col, row) coordinates.
+    max_translation bounds the translation implied by that rotation.
+
+    instead of testing every pair of vertices, the K pairs are sorted by
+    length, and each Q pair only looks at the K pairs whose length is
+    within epsilon. the candidates are expanded and tested in chunks.
+    """
+    Q_xy = np.asarray(Q_pts, dtype=np.float64)[:, ::-1]
+    K_xy = np.asarray(K_pts, dtype=np.float64)[:, ::-1]
+    nk = len(K_xy)
+
+    qi1, qi2 = np.triu_indices(len(Q_xy), 1)
+    q_diff = Q_xy[qi2] - Q_xy[qi1]
+    q_len = np.hypot(q_diff[:, 0], q_diff[:, 1])
+    q_ang = np.arctan2(q_diff[:, 1], q_diff[:, 0])
+    del q_diff
+
+    kj1, kj2, k_len, k_ang = _ordered_pairs(K_xy)
+    order = np.argsort(k_len, kind="stable")
+    kj1, kj2, k_len, k_ang = kj1[order], kj2[order], k_len[order], k_ang[order]
+
+    lo = np.searchsorted(k_len, q_len - epsilon, side="right")
+    hi = np.searchsorted(k_len, q_len + epsilon, side="left")
+    counts = np.maximum(hi - lo, 0)
+
+    edges = []
+    bounds = np.cumsum(counts)
+    start = 0
+    while start < len(counts):
+        # as many Q pairs as fit in one chunk of candidates (at least one)
+        base = bounds[start - 1] if start > 0 else 0
+        stop = max(start + 1, np.searchsorted(bounds, base + chunk_size, side="right"))
+        c = counts[start:stop]
+        total = int(c.sum())
+        if total == 0:
+            start = stop
+            continue
+        which = np.repeat(np.arange(start, stop), c)
+        offset = np.arange(total) - np.repeat(np.cumsum(c) - c, c)
+        kp = lo[which] + offset
+
+        theta = _wrap_angle(q_ang[which] - k_ang[kp])
+        keep = _motion_mask(
+            theta, Q_xy[qi1[which]], K_xy[kj1[kp]], theta_range, max_translation
+        )
+
+        which, kp = which[keep], kp[keep]
+        v1 = qi1[which] * nk + kj1[kp] + 1
+        v2 = qi2[which] * nk + kj2[kp] + 1
+        edges.append(np.column_stack((v1, v2)).astype(np.uint64))
+        start = stop
+
+    if not edges:
+        return np.zeros((0, 2), dtype=np.uint64)
+    return np.concatenate(edges)
+
+
+def top_m_candidates(Q_desc, K_desc, m):
+    """
+    for every Q descriptor, the indices of the m closest K descriptors
+    (hamming distance), as a |Q| x m array
+    """
+    Qd = np.asarray(Q_desc, dtype=np.float32)
+    Kd = np.asarray(K_desc, dtype=np.float32)
+    # number of equal bits, so larger is closer
+    agree = np.matmul(Qd, Kd.T) + np.matmul(1 - Qd, (1 - Kd).T)
+    m = max(1, min(int(m), len(Kd)))
+    if m == len(Kd):
+        return np.tile(np.arange(m), (len(Qd), 1))
+    return np.argpartition(-agree, m - 1, axis=1)[:, :m]
+
+
+def vertex_edges(
+    Q_pts,
+    K_pts,
+    vertices,
+    epsilon,
+    theta_range=None,
+    max_translation=None,
+    chunk_size=1 << 22,
+):
+    """
+    edges of the correspondence graph whose vertices are only the
+    given (Q index, K index) pairs, vertex v being vertices[*][v - 1].
+
+    every pair of vertices is tested, in vectorized chunks,
+    with the same tests as limited_edges.
+    """
+    Q_xy = np.asarray(Q_pts, dtype=np.float64)[:, ::-1]
+    K_xy = np.asarray(K_pts, dtype=np.float64)[:, ::-1]
+    vq, vk = vertices
+    V = len(vq)
+    step = max(1, chunk_size // max(V, 1))
+
+    edges = []
+    for start in range(0, V, step):
+        rows = np.arange(start, min(V, start + step))
+        a, b = np.nonzero(rows[:, None] < np.arange(V)[None, :])
+        a = rows[a]
+        qa, qb, ka, kb = vq[a], vq[b], vk[a], vk[b]
+
+        q_diff = Q_xy[qb] - Q_xy[qa]
+        k_diff = K_xy[kb] - K_xy[ka]
+        q_len = np.hypot(q_diff[:, 0], q_diff[:, 1])
+        k_len = np.hypot(k_diff[:, 0], k_diff[:, 1])
+        keep = (qa != qb) & (ka != kb) & (np.abs(q_len - k_len) < epsilon)
+        theta = _wrap_angle(
+            np.arctan2(q_diff[:, 1], q_diff[:, 0])
+            - np.arctan2(k_diff[:, 1], k_diff[:, 0])
+        )
+        keep &= _motion_mask(theta, Q_xy[qa], K_xy[ka], theta_range, max_translation)
+        edges.append(np.column_stack((a[keep] + 1, b[keep] + 1)).astype(np.uint64))
+
+    if not edges:
+        return np.zeros((0, 2), dtype=np.uint64)
+    return np.concatenate(edges)
+
+
+def _build_graph(
+    Q_pts,
+    K_pts,
+    epsilon,
+    theta_range=None,
+    max_translation=None,
+    Q_desc=None,
+    K_desc=None,
+    top_m=None,
+    vertices=None,
+):
+    """
+    the correspondence graph between Q_pts and K_pts,
+    and a function that takes clique vertices to (Q indices, K indices).
+    returns (None, None) if the graph has no edges.
+
+    the vertices of the graph are, in order of preference,
+      * the given (Q indices, K indices) pairs,
+      * the top_m descriptor matches of every Q point,
+        if top_m and descriptors for both sides are given,
+      * every (Q, K) pair.
+    """
+    nk = len(K_pts)
+
+    def decode_all(clq):
+        return (clq - 1) // nk, (clq - 1) % nk
+
+    if vertices is None and top_m is not None:
+        if Q_desc is None or K_desc is None:
+            warnings.warn("no descriptors, using all candidate vertices", RuntimeWarning)
+        else:
+            candidates = top_m_candidates(Q_desc, K_desc, top_m)
+            vertices = (
+                np.repeat(np.arange(len(Q_pts)), candidates.shape[1]),
+                candidates.ravel(),
+            )
+
+    if vertices is not None:
+        vq, vk = (np.asarray(x, dtype=np.int64) for x in vertices)
+        edges = vertex_edges(
+            Q_pts, K_pts, (vq, vk), epsilon, theta_range, max_translation
+        )
+        if len(edges) == 0:
+            return None, None
+
+        def decode_vertices(clq):
+            v = clq.astype(np.int64) - 1
+            return vq[v], vk[v]
+
+        return cliquematch.Graph.from_edgelist(edges, len(vq)), decode_vertices
+
+    if theta_range is None and max_translation is None:
+        G = cliquematch.A2AGraph(Q_pts, K_pts)
+        G.epsilon = epsilon
+        if not G.build_edges():
+            return None, None
+        return G, decode_all
+
+    edges = limited_edges(Q_pts, K_pts, epsilon, theta_range, max_translation)
+    if len(edges) == 0:
+        return None, None
+    return cliquematch.Graph.from_edgelist(edges, len(Q_pts) * nk), decode_all
+
+
+def _remap_vertices(vertices, Q_ind, K_ind, nq, nk):
+    # vertices given on the full point sets, moved to the thinned ones
+    q_new = np.full(nq, -1, dtype=np.int64)
+    k_new = np.full(nk, -1, dtype=np.int64)
+    q_new[Q_ind] = np.arange(len(Q_ind))
+    k_new[K_ind] = np.arange(len(K_ind))
+    vq, vk = q_new[vertices[0]], k_new[vertices[1]]
+    ok = (vq >= 0) & (vk >= 0)
+    return vq[ok], vk[ok]
+
+
+def _search_clique(G, ub, use_dfs=False, time_budget=None, tracer=_NULL_TRACER):
+    """
+    the largest clique of G, as an array of (1-based) vertices,
+    and a dict saying whether it is known to be maximum.
+
+    with a time_budget (seconds), the search starts from the heuristic
+    clique and stops when the budget runs out, returning the best clique
+    found so far. cliquematch does not report how many search nodes it
+    visited, so the search time is recorded instead.
+
+    when tracing, the search runs in slices of _HEARTBEAT seconds,
+    continuing where the last slice stopped, and every slice sends a
+    "clique_progress" event with the best clique size so far.
+    """
+    start = time.time()
+    can_resume = getattr(G, "search_done", None) is not None
+    if tracer.enabled and can_resume:
+        clq, done = _sliced_search(G, ub, use_dfs, time_budget, tracer, start)
+    elif not time_budget:
+        clq = G.get_max_clique(upper_bound=ub, use_dfs=use_dfs)
+        done = True
+    else:
+        clq = G.get_max_clique(
+            lower_bound=1,
+            upper_bound=ub,
+            time_limit=float(time_budget),
+            use_heuristic=True,
+            use_dfs=use_dfs,
+        )
+        done = getattr(G, "search_done", None)
+        if done is None:
+            done = (time.time() - start) < time_budget
+    clq = np.array(clq, dtype=np.uint64)
+    info = dict(
+        optimal=bool(done) or len(clq) >= ub,
+        bound_gap=int(ub - len(clq)),
+        search_time=time.time() - start,
+    )
+    return clq, info
+
+
+# seconds between the progress events of the clique search
+_HEARTBEAT = 0.25
+
+
+def _sliced_search(G, ub, use_dfs, time_budget, tracer, start):
+    clq, first = [], True
+    while True:
+        limit = _HEARTBEAT
+        if time_budget:
+            limit = min(limit, time_budget - (time.time() - start))
+            if limit <= 0:
+                return clq, False
+        clq = G.get_max_clique(
+            lower_bound=1,
+            upper_bound=ub,
+            time_limit=limit,
+            use_heuristic=first,
+            use_dfs=use_dfs,
+            continue_search=not first,
+        )
+        first = False
+        tracer.event(
+            "clique_progress", size=len(clq), ub=ub, elapsed=time.time() - start
+        )
+        if G.search_done or len(clq) >= ub:
+            return clq, True
+
+
 class Correspondence(UserDict):
     @classmethod
     def success(cls, Q_corr, K_corr, **params):
@@ -29,6 +399,8 @@ class Correspondence(UserDict):
 
 class Corresponder:
     _extname_ = "<none>"
+    # spans for the stages of a call, see tracing.py
+    tracer = _NULL_TRACER
 
     def __init__(self, *args, **params):
         pass
@@ -44,6 +416,9 @@ class Corresponder:
         """
         receive interest points from Q and K
         return a Correspondence object
+
+        the clique matchers also take vertices=(Q indices, K indices),
+        to restrict the correspondence graph to those pairs.
         """
         raise NotImplementedError("abstract base class")
 
@@ -61,44 +436,55 @@ class DummyMatcher(Corresponder):
 class CliqueMatcher(Corresponder):
     _extname_ = "clique1"
 
-    def __init__(self, epsilon: float = 0.05, use_dfs: bool = False, *args, **params):
+    def __init__(
+        self,
+        epsilon: float = 0.05,
+        use_dfs: bool = False,
+        theta_range=None,
+        max_translation=None,
+        top_m=None,
+        time_budget=None,
+        *args,
+        **params
+    ):
         super().__init__(epsilon=epsilon, use_dfs=use_dfs, *args, **params)
         self.epsilon = max(0.05, epsilon)
         self.use_dfs = use_dfs
-
-    @staticmethod
-    def get_cfunc_for_graph_build(theta_range):
-        q_diff = np.zeros(2, dtype=np.float32)
-        k_diff = np.zeros(2, dtype=np.float32)
-        invmat = np.zeros((2, 2), dtype=np.float32)
-
-        def cfunc(S1, i1, i2, S2, j1, j2) -> bool:
-            q_diff = S1[i2] - S1[i1]
-            k_diff = S2[j2] - S2[j1]
-            invmat[0, 0] = -q_diff[0]  # d
-            invmat[0, 1] = -q_diff[1]  # -b
-            invmat[1, 0] = -q_diff[1]  # -c
-            invmat[1, 1] = q_diff[0]  # a
-            res = np.matmul(k_diff, invmat)
-            theta = np.pi - np.arctan2(res[1], res[0])
-            return theta >= theta_range[0] and theta <= theta_range[1]
-
-        return cfunc
+        # rotation window in degrees, e.g. (-30, 30), see limited_edges
+        self.theta_range = theta_range
+        self.max_translation = max_translation
+        # keep only the top_m descriptor matches per Q point as vertices
+        self.top_m = top_m
+        # seconds allowed for the clique search, None for no limit
+        self.time_budget = time_budget
 
     def _call_impl(self, Q, K, *args, **params) -> Correspondence:
         if len(Q.points) <= 2 or len(K.points) <= 2:
             warnings.warn("not enough interest points")
             return Correspondence.failure()
-        # ADD A DECENT CONDITION FUNCTION
-        # TO HAVE A SPARSER GRAPH
-        # THE RECTANGLE OVERLAP CHECK
-        # OR A ROTATION LIMIT
+        # a rotation window (and translation bound) prunes edges
+        # while the graph is built, see limited_edges,
+        # and top_m or vertices prune vertices, see vertex_edges.
         # OTHERWISE when building edges, give a large epsilon and
         # set use_dfs = False, in the clique search
         try:
-            G = cliquematch.A2AGraph(Q.points, K.points)
-            G.epsilon = self.epsilon
-            if not G.build_edges():
+            with self.tracer.span(
+                "graph", q_pts=len(Q.points), k_pts=len(K.points)
+            ) as span:
+                G, decode = _build_graph(
+                    Q.points,
+                    K.points,
+                    self.epsilon,
+                    theta_range=self.theta_range,
+                    max_translation=self.max_translation,
+                    Q_desc=getattr(Q, "descriptors", None),
+                    K_desc=getattr(K, "descriptors", None),
+                    top_m=self.top_m,
+                    vertices=params.get("vertices"),
+                )
+                if G is not None:
+                    span.update(V=G.n_vertices, E=G.n_edges)
+            if G is None:
                 warnings.warn(
                     "unable to construct correspondence graph", RuntimeWarning
                 )
@@ -112,14 +498,18 @@ class CliqueMatcher(Corresponder):
         dens = (2.0 * E) / (V * (V - 1))
         ub = min(len(K.points), len(Q.points))
         try:
-            clq = np.array(
-                G.get_max_clique(upper_bound=ub, use_dfs=False), dtype=np.uint64
-            )
-            corr = (
-                Q.points[(clq - 1) // len(K.points)],
-                K.points[(clq - 1) % len(K.points)],
-            )
-        except Exception:
+            with self.tracer.span("clique", V=V, E=E, ub=ub) as span:
+                clq, search = _search_clique(
+                    G,
+                    ub,
+                    use_dfs=self.use_dfs,
+                    time_budget=self.time_budget,
+                    tracer=self.tracer,
+                )
+                span.update(size=len(clq), **search)
+            qi, ki = decode(clq)
+            corr = (Q.points[qi], K.points[ki])
+        except Exception as e:
             print(e, "correspondence")
             warnings.warn("unable to find maximum clique", RuntimeWarning)
             return Correspondence.failure(graph_V=0, graph_E=0)
@@ -131,6 +521,7 @@ class CliqueMatcher(Corresponder):
             ratio=100 * len(corr[0]) / ub,
             graph_V=G.n_vertices,
             graph_E=G.n_edges,
+            **search
         )
         del G
         # print("clique size is", answer["size"])
@@ -144,6 +535,10 @@ class CliqueMatcherWithTuning(Corresponder):
         epsilon: float = 0.05,
         use_dfs: bool = False,
         alpha: float = 0.01,
+        theta_range=None,
+        max_translation=None,
+        top_m=None,
+        time_budget=None,
         *args,
         **params
     ):
@@ -151,38 +546,61 @@ class CliqueMatcherWithTuning(Corresponder):
         self.epsilon = max(0.05, epsilon)
         self.use_dfs = use_dfs
         self.alpha = max(0.0, alpha)
+        # rotation window in degrees, e.g. (-30, 30), see limited_edges
+        self.theta_range = theta_range
+        self.max_translation = max_translation
+        # keep only the top_m descriptor matches per Q point as vertices
+        self.top_m = top_m
+        # seconds allowed for the clique search, None for no limit
+        self.time_budget = time_budget
 
     def _split(self, pts):
-        if self.alpha <= 0.0:
-            return pts
-        is_pt = np.ones(len(pts), dtype=np.bool_)
-        ind = rtree.index.Index()
-        r = self.alpha
-        for i, p in enumerate(pts):
-            px, py = p
-            nearby = ind.intersection((px - r, py - r, px + r, py + r))
-            if any(np.linalg.norm(p - pts[j]) <= r for j in nearby):
-                is_pt[i] = False
-            else:
-                ind.insert(i, (px, py, px, py))
-        return pts[is_pt]
+        return thin_indices(pts, self.alpha)
 
     def _call_impl(self, Q, K, *args, **params) -> Correspondence:
-        Q_sep_points = self._split(Q.points)
-        K_sep_points = self._split(K.points)
+        with self.tracer.span(
+            "thin", alpha=self.alpha, q_pts=len(Q.points), k_pts=len(K.points)
+        ) as span:
+            Q_ind = self._split(Q.points)
+            K_ind = self._split(K.points)
+            span.update(q_kept=len(Q_ind), k_kept=len(K_ind))
+        Q_sep_points = Q.points[Q_ind]
+        K_sep_points = K.points[K_ind]
+        Q_desc = getattr(Q, "descriptors", None)
+        K_desc = getattr(K, "descriptors", None)
+        if Q_desc is not None and K_desc is not None:
+            Q_desc, K_desc = Q_desc[Q_ind], K_desc[K_ind]
+        vertices = params.get("vertices")
+        if vertices is not None:
+            vertices = _remap_vertices(
+                vertices, Q_ind, K_ind, len(Q.points), len(K.points)
+            )
         if len(Q_sep_points) <= 2 or len(K_sep_points) <= 2:
             warnings.warn("not enough interest points")
             return Correspondence.failure()
-        # ADD A DECENT CONDITION FUNCTION
-        # TO HAVE A SPARSER GRAPH
-        # THE RECTANGLE OVERLAP CHECK
-        # OR A ROTATION LIMIT
+        # a rotation window (and translation bound) prunes edges
+        # while the graph is built, see limited_edges,
+        # and top_m or vertices prune vertices, see vertex_edges.
         # OTHERWISE when building edges, give a large epsilon and
         # set use_dfs = False, in the clique search
         try:
-            G = cliquematch.A2AGraph(Q_sep_points, K_sep_points)
-            G.epsilon = self.epsilon
-            if not G.build_edges():
+            with self.tracer.span(
+                "graph", q_pts=len(Q_sep_points), k_pts=len(K_sep_points)
+            ) as span:
+                G, decode = _build_graph(
+                    Q_sep_points,
+                    K_sep_points,
+                    self.epsilon,
+                    theta_range=self.theta_range,
+                    max_translation=self.max_translation,
+                    Q_desc=Q_desc,
+                    K_desc=K_desc,
+                    top_m=self.top_m,
+                    vertices=vertices,
+                )
+                if G is not None:
+                    span.update(V=G.n_vertices, E=G.n_edges)
+            if G is None:
                 warnings.warn(
                     "unable to construct correspondence graph", RuntimeWarning
                 )
@@ -196,14 +614,18 @@ class CliqueMatcherWithTuning(Corresponder):
         dens = (2.0 * E) / (V * (V - 1))
         ub = min(len(K_sep_points), len(Q_sep_points))
         try:
-            clq = np.array(
-                G.get_max_clique(upper_bound=ub, use_dfs=False), dtype=np.uint64
-            )
-            corr = (
-                Q_sep_points[(clq - 1) // len(K_sep_points)],
-                K_sep_points[(clq - 1) % len(K_sep_points)],
-            )
-        except Exception:
+            with self.tracer.span("clique", V=V, E=E, ub=ub) as span:
+                clq, search = _search_clique(
+                    G,
+                    ub,
+                    use_dfs=self.use_dfs,
+                    time_budget=self.time_budget,
+                    tracer=self.tracer,
+                )
+                span.update(size=len(clq), **search)
+            qi, ki = decode(clq)
+            corr = (Q_sep_points[qi], K_sep_points[ki])
+        except Exception as e:
             print(e, "correspondence")
             warnings.warn("unable to find maximum clique", RuntimeWarning)
             return Correspondence.failure(graph_V=0, graph_E=0)
@@ -215,12 +637,162 @@ class CliqueMatcherWithTuning(Corresponder):
             ratio=100 * len(corr[0]) / ub,
             graph_V=G.n_vertices,
             graph_E=G.n_edges,
+            **search
         )
         del G
         # print("clique size is", answer["size"])
         return answer
 
 
+def _knn_pairs(xy, k):
+    """
+    ordered pairs (i, j) where j is one of the k nearest neighbours of i,
+    together with the reversed pairs, and their length and direction
+    """
+    n = len(xy)
+    k = min(k, n - 1)
+    _, nbrs = spatial.cKDTree(xy).query(xy, k=k + 1)
+    i = np.repeat(np.arange(n), k)
+    j = nbrs[:, 1:].ravel()
+    i, j = np.concatenate((i, j)), np.concatenate((j, i))
+    diff = xy[j] - xy[i]
+    return i, j, np.hypot(diff[:, 0], diff[:, 1]), np.arctan2(diff[:, 1], diff[:, 0])
+
+
+def _fit_rigid(src, dst):
+    """
+    least-squares rotation R and translation t with dst ~ src @ R.T + t
+    """
+    src_cent, src_norm = src.mean(axis=0), src - src.mean(axis=0)
+    dst_cent, dst_norm = dst.mean(axis=0), dst - dst.mean(axis=0)
+    U, _, Vt = np.linalg.svd(np.matmul(src_norm.T, dst_norm))
+    d = np.sign(np.linalg.det(np.matmul(Vt.T, U.T)))
+    R = np.matmul(np.matmul(Vt.T, np.diag([1.0, d])), U.T)
+    return R, dst_cent - np.matmul(src_cent, R.T)
+
+
+class RansacMatcher(Corresponder):
+    """
+    randomized rigid matching, for when a predictable cost matters
+    more than finding the exact maximum clique.
+
+    every hypothesis pairs a Q point with one of its nearest neighbours,
+    and a K pair of the same length (within epsilon), which fixes a
+    rotation and translation. batches of hypotheses are scored at once
+    by mapping all of K into Q and counting the K points with a Q point
+    within epsilon2, through a KD-tree over Q.
+    the number of hypotheses adapts to the best inlier ratio seen so far,
+    and the random generator is seeded, so results are repeatable.
+    """
+
+    _extname_ = "ransac"
+
+    def __init__(
+        self,
+        epsilon: float = 0.5,
+        epsilon2: float = 5.0,
+        alpha: float = 0.0,
+        neighbours: int = 8,
+        confidence: float = 0.99,
+        max_iter: int = 20000,
+        batch_size: int = 64,
+        seed: int = 0,
+        *args,
+        **params
+    ):
+        super().__init__(*args, **params)
+        self.epsilon = max(0.05, epsilon)
+        self.epsilon2 = max(self.epsilon, epsilon2)
+        self.alpha = max(0.0, alpha)
+        self.neighbours = neighbours
+        self.confidence = confidence
+        self.max_iter = max_iter
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def _inliers(self, tree, K_xy, R, t):
+        # one-to-one pairs (Q index, K index) within epsilon2
+        dist, qi = tree.query(
+            np.matmul(K_xy, R.T) + t, k=1, distance_upper_bound=self.epsilon2
+        )
+        ki = np.flatnonzero(np.isfinite(dist))
+        qi, dist = qi[ki], dist[ki]
+        # a Q point keeps only its closest K point
+        order = np.lexsort((dist, qi))
+        first = np.ones(len(order), dtype=np.bool_)
+        first[1:] = qi[order][1:] != qi[order][:-1]
+        return qi[order][first], ki[order][first]
+
+    def _call_impl(self, Q, K, *args, **params) -> Correspondence:
+        Q_pts = thin_points(Q.points, self.alpha)
+        K_pts = thin_points(K.points, self.alpha)
+        if len(Q_pts) <= 2 or len(K_pts) <= 2:
+            warnings.warn("not enough interest points")
+            return Correspondence.failure()
+        Q_xy = np.asarray(Q_pts, dtype=np.float64)[:, ::-1]
+        K_xy = np.asarray(K_pts, dtype=np.float64)[:, ::-1]
+        ub = min(len(Q_pts), len(K_pts))
+        tree = spatial.cKDTree(Q_xy)
+        rng = np.random.RandomState(self.seed)
+
+        qi1, _, q_len, q_ang = _knn_pairs(Q_xy, self.neighbours)
+        kj1, _, k_len, k_ang = _knn_pairs(K_xy, self.neighbours)
+        order = np.argsort(k_len, kind="stable")
+        kj1, k_len, k_ang = kj1[order], k_len[order], k_ang[order]
+        lo = np.searchsorted(k_len, q_len - self.epsilon, side="left")
+        hi = np.searchsorted(k_len, q_len + self.epsilon, side="right")
+        usable = np.flatnonzero(hi > lo)
+        if len(usable) == 0:
+            return Correspondence.failure()
+        mean_choices = np.mean(hi[usable] - lo[usable])
+
+        best_count, best_R, best_t = 0, np.eye(2), np.zeros(2)
+        needed, done = self.max_iter, 0
+        while done < min(needed, self.max_iter):
+            h = usable[rng.randint(0, len(usable), size=self.batch_size)]
+            kp = lo[h] + (rng.random_sample(len(h)) * (hi[h] - lo[h])).astype(np.int64)
+            theta = q_ang[h] - k_ang[kp]
+            cos, sin = np.cos(theta), np.sin(theta)
+            R = np.stack((np.stack((cos, -sin), -1), np.stack((sin, cos), -1)), -2)
+            t = Q_xy[qi1[h]] - np.einsum("hij,hj->hi", R, K_xy[kj1[kp]])
+
+            mapped = np.einsum("hij,kj->hki", R, K_xy) + t[:, None, :]
+            dist, _ = tree.query(
+                mapped.reshape(-1, 2), k=1, distance_upper_bound=self.epsilon2
+            )
+            counts = np.isfinite(dist).reshape(len(h), -1).sum(axis=1)
+            done += len(h)
+
+            b = int(np.argmax(counts))
+            if counts[b] > best_count:
+                best_count, best_R, best_t = counts[b], R[b], t[b]
+                # a hypothesis is good if both Q points are inliers
+                # and the right K pair was picked among the candidates
+                w = min(1.0, best_count / ub)
+                p_good = min(w * w / mean_choices, 1 - 1e-12)
+                needed = int(
+                    np.ceil(np.log(1 - self.confidence) / np.log(1 - p_good))
+                )
+
+        if best_count < 3:
+            return Correspondence.failure(hypotheses=done)
+        qi, ki = self._inliers(tree, K_xy, best_R, best_t)
+        # refine once on all the inliers
+        R, t = _fit_rigid(K_xy[ki], Q_xy[qi])
+        qi_ref, ki_ref = self._inliers(tree, K_xy, R, t)
+        if len(qi_ref) >= len(qi):
+            qi, ki = qi_ref, ki_ref
+
+        return Correspondence.success(
+            Q_corr=Q_pts[qi],
+            K_corr=K_pts[ki],
+            ub=ub,
+            ratio=100 * len(qi) / ub,
+            hypotheses=done,
+            optimal=False,
+        )
+
+
 CORRESPONDER_MAP = {
     x._extname_: x for x in Corresponder.__subclasses__() if x._extname_ != "dummy"
 }
@@ -1,6 +1,8 @@
 # - * - coding : utf - 8 - * -
 import numpy as np
-from skimage.feature import ORB, CENSURE, corner_fast, corner_peaks
+from _lazy import lazy_import
+
+skfeat = lazy_import("skimage.feature")
 
 # config
 from _reconfig import Config
@@ -15,12 +17,23 @@ def uniqueify(f):
     return g
 
 
+def unique_with_descriptors(points, descriptors):
+    # same order as uniqueify, keeping the descriptors in step
+    points, index = np.unique(points, axis=0, return_index=True)
+    return points, descriptors[index]
+
+
 class Extractor:
     _extname_ = "<none>"
+    # names of the Config entries this extractor reads
+    _params_ = ()
 
     def __init__(self, *args, **kwargs):
         pass
 
+    def get_params(self):
+        return {x: Config.get_params(x) for x in self._params_}
+
     def __call__(self, img):
         """
         receive an image (grayscale) => return interest points
@@ -28,26 +41,43 @@ class Extractor:
         """
         raise NotImplementedError("abstract base class")
 
+    def describe(self, img):
+        """
+        receive an image (grayscale) => return (interest points, descriptors)
+        descriptors are binary, one row per interest point.
+        points too close to the border to be described are dropped.
+        """
+        points = self(img)
+        brief = skfeat.BRIEF()
+        brief.extract(img, points)
+        return points[brief.mask], brief.descriptors
+
 
 class ORBExtractor(Extractor):
     _extname_ = "ORB"
+    _params_ = ("ORB",)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.etor = ORB(**Config.get_params("ORB"))
+        self.etor = skfeat.ORB(**Config.get_params("ORB"))
 
     @uniqueify
     def __call__(self, img):
         self.etor.detect(img)
         return self.etor.keypoints
 
+    def describe(self, img):
+        self.etor.detect_and_extract(img)
+        return unique_with_descriptors(self.etor.keypoints, self.etor.descriptors)
+
 
 class CENSUREExtractor(Extractor):
     _extname_ = "CENSURE"
+    _params_ = ("CENSURE",)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.etor = CENSURE(**Config.get_params("CENSURE"))
+        self.etor = skfeat.CENSURE(**Config.get_params("CENSURE"))
 
     @uniqueify
     def __call__(self, img):
@@ -57,11 +87,12 @@ class CENSUREExtractor(Extractor):
 
 class FastExtractor(Extractor):
     _extname_ = "FAST"
+    _params_ = ("FAST_params", "FAST_peaks")
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.etor = lambda img: corner_peaks(
-            corner_fast(img, **Config.get_params("FAST_params")),
+        self.etor = lambda img: skfeat.corner_peaks(
+            skfeat.corner_fast(img, **Config.get_params("FAST_params")),
             **Config.get_params("FAST_peaks")
         )
 
@@ -0,0 +1,330 @@
+"""
+geometric-hash index over a gallery of K prints.
+
+every interest point p, with each of its nearest neighbours a as a basis,
+describes its other nearest neighbours b in the frame where a - p lies
+along the x axis. the key (|a - p|, b'_x, b'_y), quantized, does not
+change when the print is rotated or shifted.
+
+the keys of all gallery prints go into one sorted array, stored on disk
+as .npy files that are memory-mapped when the index is loaded. a Q print
+votes for the gallery prints that share its keys, and only the top-N
+candidates then go through the full comparison (see batch.py).
+
+keys that many prints share, e.g. from the near-regular patterns of
+a tread, say little about which print Q came from and would swamp the
+votes: keys found in more than max_share of the gallery are stop-listed,
+they get no votes.
+
+    python gindex.py build gallery K1.tiff K2.tiff ...
+    python gindex.py search gallery Q.tiff --top-n 50
+"""
+__all__ = ("point_keys", "GalleryIndex", "search", "main")
+
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+import numpy as np
+from scipy.spatial import cKDTree
+
+from extractor import EXTRACTOR_MAP
+from runner import load_image, extract_points
+from batch import compare_many, rank_results
+
+_OFFSET = 1 << 19
+_MASK = (1 << 20) - 1
+# the arrays of a GalleryIndex, one .npy file each
+_ARRAYS = ("keys", "ids", "n_keys")
+
+
+def point_keys(points, neighbours=4, quant=4.0):
+    """
+    the distinct geometric-hash keys of a set of (row, col) points
+    """
+    xy = np.asarray(points, dtype=np.float64)[:, ::-1]
+    n = len(xy)
+    k = min(neighbours, n - 1)
+    if k < 2:
+        return np.zeros(0, dtype=np.int64)
+    _, nbrs = cKDTree(xy).query(xy, k=k + 1)
+    nbrs = nbrs[:, 1:]
+
+    # every (p, a, b) with a != b among the neighbours of p
+    ia, ib = np.nonzero(~np.eye(k, dtype=np.bool_))
+    p = np.repeat(np.arange(n), len(ia))
+    a = nbrs[:, ia].ravel()
+    b = nbrs[:, ib].ravel()
+
+    base = xy[a] - xy[p]
+    other = xy[b] - xy[p]
+    length = np.hypot(base[:, 0], base[:, 1])
+    cos, sin = base[:, 0] / length, base[:, 1] / length
+    bx = cos * other[:, 0] + sin * other[:, 1]
+    by = -sin * other[:, 0] + cos * other[:, 1]
+
+    qd = np.round(length / quant).astype(np.int64) & _MASK
+    qx = (np.round(bx / quant).astype(np.int64) + _OFFSET) & _MASK
+    qy = (np.round(by / quant).astype(np.int64) + _OFFSET) & _MASK
+    return np.unique((qd << 40) | (qx << 20) | qy)
+
+
+_STATE = {}
+
+
+def _init_worker(etor_name, store, neighbours, quant):
+    _STATE.update(
+        extractor=EXTRACTOR_MAP[etor_name](),
+        store=store,
+        neighbours=neighbours,
+        quant=quant,
+    )
+
+
+def _keys_for(k_path):
+    k = load_image(k_path, is_k=True, store=_STATE["store"])
+    extract_points(_STATE["extractor"], k, store=_STATE["store"])
+    return point_keys(k.points, _STATE["neighbours"], _STATE["quant"])
+
+
+class GalleryIndex:
+    def __init__(self, etor_name, neighbours=4, quant=4.0, max_share=0.05):
+        self.etor_name = etor_name
+        self.neighbours = neighbours
+        self.quant = quant
+        # keys in more than this fraction of the prints get no votes
+        self.max_share = max_share
+        self.paths = []
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int32)
+        self.n_keys = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def build(
+        cls,
+        k_paths,
+        etor_name,
+        neighbours=4,
+        quant=4.0,
+        max_share=0.05,
+        store=None,
+        workers=None,
+    ):
+        index = cls(
+            etor_name, neighbours=neighbours, quant=quant, max_share=max_share
+        )
+        index.add(k_paths, store=store, workers=workers)
+        return index
+
+    def add(self, k_paths, store=None, workers=None):
+        k_paths = list(k_paths)
+        initargs = (self.etor_name, store, self.neighbours, self.quant)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(k_paths)))
+        if workers == 1:
+            _init_worker(*initargs)
+            all_keys = [_keys_for(x) for x in k_paths]
+        else:
+            with multiprocessing.Pool(
+                processes=workers, initializer=_init_worker, initargs=initargs
+            ) as pool:
+                all_keys = pool.map(_keys_for, k_paths, chunksize=4)
+
+        start = len(self.paths)
+        ids = [np.full(len(x), start + i, dtype=np.int32) for i, x in enumerate(all_keys)]
+        keys = np.concatenate([self.keys] + all_keys)
+        ids = np.concatenate([self.ids] + ids)
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.ids = keys[order], ids[order]
+        self.n_keys = np.concatenate(
+            (self.n_keys, np.array([len(x) for x in all_keys], dtype=np.int64))
+        )
+        self.paths.extend(k_paths)
+
+    def query(self, q_points, top_n=50):
+        """
+        the top_n gallery paths sharing the most keys with q_points,
+        as a list of (path, score), best first
+        """
+        q_keys = point_keys(q_points, self.neighbours, self.quant)
+        if len(q_keys) == 0 or len(self.paths) == 0:
+            return []
+        lo = np.searchsorted(self.keys, q_keys, side="left")
+        hi = np.searchsorted(self.keys, q_keys, side="right")
+        counts = hi - lo
+        # every print has a key at most once, so counts are numbers of prints
+        counts[counts > max(1, self.max_share * len(self.paths))] = 0
+        total = int(counts.sum())
+        pos = np.repeat(lo, counts) + (
+            np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        )
+        votes = np.bincount(self.ids[pos], minlength=len(self.paths))
+        # cosine between the key sets, so large prints do not win by size
+        score = votes / np.sqrt(np.maximum(self.n_keys, 1) * len(q_keys))
+        best = np.argsort(-score, kind="stable")[:top_n]
+        return [(self.paths[i], float(score[i])) for i in best if votes[i] > 0]
+
+    def save(self, path):
+        """
+        write the index to the directory path: one .npy file per array,
+        and the parameters and gallery paths in meta.json
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        meta = dict(
+            etor_name=self.etor_name,
+            neighbours=self.neighbours,
+            quant=self.quant,
+            max_share=self.max_share,
+            paths=self.paths,
+        )
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        the index saved in the directory path, with its arrays memory-mapped,
+        or in the single .npz file of older versions, read into memory
+        """
+        if os.path.isfile(path):
+            return cls._load_npz(path)
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        paths = meta.pop("paths")
+        index = cls(**meta)
+        index.paths = paths
+        for name in _ARRAYS:
+            arr = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            setattr(index, name, arr)
+        return index
+
+    @classmethod
+    def _load_npz(cls, path):
+        with np.load(path, allow_pickle=False) as z:
+            meta = json.loads(str(z["meta"]))
+            index = cls(**meta)
+            index.paths = [str(x) for x in z["paths"]]
+            for name in _ARRAYS:
+                setattr(index, name, z[name])
+        return index
+
+
+def search(
+    q_path,
+    index,
+    aligner,
+    scorer,
+    epsilon,
+    alpha,
+    top_n=50,
+    workers=None,
+    store=None,
+    **cder_params
+):
+    """
+    vote for the top_n candidates through the index,
+    then run compare_many on those, yielding results as they finish
+    """
+    q = load_image(q_path, is_k=False, store=store)
+    extract_points(EXTRACTOR_MAP[index.etor_name](), q, store=store)
+    candidates = [x[0] for x in index.query(q.points, top_n=top_n)]
+    if not candidates:
+        return
+    for res in compare_many(
+        q_path,
+        candidates,
+        q_desc=q,
+        extractor=index.etor_name,
+        aligner=aligner,
+        scorer=scorer,
+        epsilon=epsilon,
+        alpha=alpha,
+        workers=workers,
+        store=store,
+        **cder_params
+    ):
+        yield res
+
+
+def main(argv=None):
+    from aligner import ALIGNER_MAP
+    from scorer import SCORINGMETHOD_MAP
+
+    parser = argparse.ArgumentParser(description="geometric-hash gallery index")
+    sub = parser.add_subparsers(dest="command")
+
+    p_build = sub.add_parser("build", help="index a gallery of K prints")
+    p_build.add_argument("index")
+    p_build.add_argument("k_paths", nargs="+")
+    p_build.add_argument(
+        "--extractor", default="ORB", choices=sorted(EXTRACTOR_MAP.keys())
+    )
+    p_build.add_argument("--neighbours", type=int, default=4)
+    p_build.add_argument("--quant", type=float, default=4.0)
+    p_build.add_argument(
+        "--max-share",
+        type=float,
+        default=0.05,
+        help="keys in more than this fraction of the prints get no votes",
+    )
+    p_build.add_argument("--workers", type=int, default=None)
+
+    p_search = sub.add_parser("search", help="search the gallery for a Q print")
+    p_search.add_argument("index")
+    p_search.add_argument("q_path")
+    p_search.add_argument("--top-n", type=int, default=50)
+    p_search.add_argument(
+        "--aligner", default="kabsch", choices=list(ALIGNER_MAP.keys())
+    )
+    p_search.add_argument(
+        "--scorer", default="clique_fraction", choices=list(SCORINGMETHOD_MAP.keys())
+    )
+    p_search.add_argument("--epsilon", type=float, default=0.5)
+    p_search.add_argument("--alpha", type=float, default=5.0)
+    p_search.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        index = GalleryIndex.build(
+            args.k_paths,
+            args.extractor,
+            neighbours=args.neighbours,
+            quant=args.quant,
+            max_share=args.max_share,
+            workers=args.workers,
+        )
+        index.save(args.index)
+        print("indexed %d prints, %d keys" % (len(index.paths), len(index.keys)))
+    elif args.command == "search":
+        index = GalleryIndex.load(args.index)
+        results = list(
+            search(
+                args.q_path,
+                index,
+                aligner=args.aligner,
+                scorer=args.scorer,
+                epsilon=args.epsilon,
+                alpha=args.alpha,
+                top_n=args.top_n,
+                workers=args.workers,
+            )
+        )
+        print("rank\tscore\tk_path")
+        for res in rank_results(results):
+            if res["success"]:
+                print("%d\t%.6f\t%s" % (res["rank"], res["score"], res["k_path"]))
+            else:
+                print("-\t-\t%s\t%s" % (res["k_path"], res["message"]))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
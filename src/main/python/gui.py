@@ -4,29 +4,27 @@
     Select source TIFF files, output target folder, and
     toggle advanced options if needed.
 """
-import matplotlib
-
-matplotlib.use("Qt5Agg")
-
-from matplotlib.backends.backend_qt5agg import (
-    FigureCanvasQTAgg,
-    NavigationToolbar2QT as NavigationToolbar,
-)
-from matplotlib.figure import Figure
-
 import PyQt5.QtWidgets as qtgui
 import PyQt5.QtCore as qtcore
 import threading
-import time
 import gc
 
-from runner import runner
-from presenter import write_plot
+import refdist
+from _lazy import preload
+from runner import WorkerProgress
+from procworker import ComparisonWorker
 from aligner import ALIGNER_MAP
 from extractor import EXTRACTOR_MAP
 from scorer import SCORINGMETHOD_MAP
 
 
+def _preload_report():
+    # nothing here touches a widget, so it can run off the main thread
+    import report  # noqa: F401
+
+    preload(["skimage.io"])
+
+
 class PercentageWorker(qtcore.QObject):
     # https://stackoverflow.com/questions/66265219
     started = qtcore.pyqtSignal()
@@ -66,29 +64,6 @@ class PercentageWorker(qtcore.QObject):
         self.finished.emit()
 
 
-class MplCanvas(FigureCanvasQTAgg):
-    def __init__(self, parent=None, width=14, height=12, dpi=100):
-        fig = Figure(figsize=(width, height), dpi=dpi)
-        super(MplCanvas, self).__init__(fig)
-
-
-class SuccessDialog(qtgui.QDialog):
-    # https://www.pythonguis.com/tutorials/plotting-matplotlib/
-    def __init__(self, sinfo, parent):
-        super().__init__(parent)
-
-        self.setWindowTitle("Shoeprint Comparison")
-        sc = MplCanvas(parent=self)
-        write_plot(sc.figure, sinfo)
-
-        toolbar = NavigationToolbar(sc, self)
-
-        layout = qtgui.QVBoxLayout()
-        layout.addWidget(sc)
-        layout.addWidget(toolbar)
-        self.setLayout(layout)
-
-
 class FailureDialog(qtgui.QDialog):
     def __init__(self, parent, message=None):
         super().__init__(parent)
@@ -135,11 +110,20 @@ class SelWindow(qtgui.QMainWindow):
         # self.setFixedSize(1020, 620)
         self.success = False
         self.sinfo = None
+        # comparisons run in a separate process, see procworker.py
+        self.comparer = ComparisonWorker(refdist_path=self._refdist_path())
+        self.worker = None
+        self.job_progress = None
+        self.poller = qtcore.QTimer(self)
+        self.poller.timeout.connect(self.poll_worker)
 
         self.central = qtgui.QWidget()
 
         self.go_button = qtgui.QPushButton("Go!", parent=self)
         self.go_button.clicked.connect(self.listener)
+        self.cancel_button = qtgui.QPushButton("Cancel", parent=self)
+        self.cancel_button.clicked.connect(self.listener)
+        self.cancel_button.setDisabled(True)
         self.progress = qtgui.QProgressBar()
         self.dbg = qtgui.QLabel("")
 
@@ -195,6 +179,7 @@ class SelWindow(qtgui.QMainWindow):
         self.layout.addWidget(qtgui.QLabel("Similarity Score: "), 14, 1)
         self.layout.addWidget(self.score_options, 14, 2)
         self.layout.addWidget(self.go_button, 15, 1, 2, 2)
+        self.layout.addWidget(self.cancel_button, 17, 1, 1, 2)
         self.layout.addWidget(qtgui.QLabel("Progress: "), 20, 0)
         self.layout.addWidget(self.progress, 20, 1)
         self.layout.addWidget(self.dbg, 20, 2, 1, 2)
@@ -218,6 +203,8 @@ class SelWindow(qtgui.QMainWindow):
             self.set_file(2)
         elif sender == self.go_button:
             self.done_button()
+        elif sender == self.cancel_button:
+            self.cancel_job()
 
     def set_file(self, file_no):
         """To open the appropriate file/directory selection
@@ -238,23 +225,76 @@ class SelWindow(qtgui.QMainWindow):
         if fl_text[0] != "":
             fl.setText(fl_text[0])
 
+    def _refdist_path(self):
+        try:
+            return self.ctx.get_resource(refdist.FILENAME)
+        except (OSError, AttributeError):
+            return None
+
+    def _set_running(self, running):
+        self.go_button.setDisabled(running)
+        self.cancel_button.setDisabled(not running)
+
     def done_button(self):
-        worker = PercentageWorker()
-        worker.percentageChanged.connect(self.progress.setValue)
-        worker.txtChanged.connect(self.dbg.setText)
-        worker.finished.connect(self.post_viz)
+        self.worker = PercentageWorker()
+        self.worker.percentageChanged.connect(self.progress.setValue)
+        self.worker.txtChanged.connect(self.dbg.setText)
+        self.worker.finished.connect(self.post_viz)
+        self.job_progress = WorkerProgress(self.worker)
         self.progress.setValue(0)
         self.dbg.setText("")
-        threading.Thread(
-            target=runner,
-            kwargs=dict(window=self, worker=worker),
-            daemon=True,
-        ).start()
+        self.worker.start()
+        self.comparer.submit(
+            k_path=self.file1.text(),
+            q_path=self.file2.text(),
+            etor_name=self.point_options.currentText(),
+            aligner_name=self.align_options.currentText(),
+            scorer_name=self.score_options.currentText(),
+            epsilon=self.clique_eps.text(),
+            alpha=self.clique_alpha.text(),
+        )
+        self._set_running(True)
+        self.poller.start(50)
+
+    def poll_worker(self):
+        for kind, job_id, payload in self.comparer.poll():
+            if kind == "progress":
+                self.job_progress(*payload)
+            elif kind == "result":
+                self.poller.stop()
+                self._set_running(False)
+                self.success, self.sinfo = payload
+                if self.success:
+                    self.worker.debug_text = "creating report"
+                    self.worker.percentage = 100
+                self.worker.finish()
+
+    def cancel_job(self):
+        self.poller.stop()
+        self.comparer.cancel()
+        self._set_running(False)
+        self.reset_everything()
+        self.dbg.setText("cancelled")
+
+    def preload_report(self):
+        """
+        import what the report needs in the background, once the window
+        is up, so that the first report does not wait for matplotlib
+        """
+        threading.Thread(target=_preload_report, daemon=True).start()
+
+    def closeEvent(self, event):
+        self.poller.stop()
+        self.comparer.close()
+        super().closeEvent(event)
 
     def post_viz(self):
         if self.success:
             self.dbg.setText("success")
             self.sinfo["loader"] = lambda x: self.ctx.get_resource(x)
+            # matplotlib is only needed from here on, see preload_report
+            from report import SuccessDialog
+
             succ = SuccessDialog(sinfo=self.sinfo, parent=self)
             succ.show()
             self.reset_everything()
@@ -269,6 +309,9 @@ class SelWindow(qtgui.QMainWindow):
     def reset_everything(self):
         self.success = False
         self.sinfo = None
+        # the comparison process and the poller are kept for the next job
+        self.worker = None
+        self.job_progress = None
         self.progress.setValue(0)
         self.dbg.setText("")
         gc.collect()
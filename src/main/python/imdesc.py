@@ -1,19 +1,289 @@
 # -*- coding: utf-8 -*-
 import os
 import numpy as np
-from skimage import io as skio
-from skimage import util as skutil
-from skimage import transform as sktrans
+from _lazy import lazy_import
+
+skio = lazy_import("skimage.io")
+skutil = lazy_import("skimage.util")
+sktrans = lazy_import("skimage.transform")
 
 #
 from _reconfig import Config
 
+ndi = lazy_import("scipy.ndimage")
+
+# rows of output produced per band in _read_reduced_tiff
+_BAND_ROWS = 64
+# same weights as skimage.color.rgb2gray
+_GRAY_WEIGHTS = np.array([0.2125, 0.7154, 0.0721])
+
+
+def _to_unit_float(x):
+    # same ranges as skimage.img_as_float, for the dtypes _read_reduced_tiff takes
+    if np.issubdtype(x.dtype, np.unsignedinteger):
+        return x.astype(np.float64) / np.iinfo(x.dtype).max
+    return x.astype(np.float64)
+
+
+def _sample_grid(n_in, n_out):
+    # where rescale samples output pixels 0..n_out-1 in the input,
+    # (o + 0.5) * factor - 0.5, split into lower neighbour and weight
+    factor = n_in / n_out
+    pos = (np.arange(n_out) + 0.5) * factor - 0.5
+    low = np.clip(np.floor(pos).astype(np.intp), 0, n_in - 1)
+    return low, pos - low, factor
+
+
+def _linear(band, low, weight, axis, offset):
+    # linear interpolation of band along axis, at low + weight (input coords)
+    i0 = low - offset
+    i1 = np.minimum(low + 1, offset + band.shape[axis] - 1) - offset
+    a = np.take(band, i0, axis=axis)
+    b = np.take(band, i1, axis=axis)
+    shape = [1, 1]
+    shape[axis] = -1
+    weight = weight.reshape(shape)
+    return a * (1.0 - weight) + b * weight
+
+
+def _read_reduced_tiff(filepath, scale, crop):
+    """
+    the same pixels as imread(as_gray=True) + rescale(scale, mode="symmetric",
+    anti_aliasing=True) + crop, without holding the full-resolution image
+    in memory as floats.
+
+    the pixels are mapped (or decoded into a temporary memmap) by tifffile,
+    and only the rows and columns that the cropped output depends on are
+    read. they go through the same steps as rescale, band by band:
+    the gaussian prefilter with sigma = (factor - 1) / 2 over bands that
+    overlap by its radius, then linear interpolation at the pixel centres
+    of the output, whose size is round(scale * shape).
+
+    returns None when this path does not apply (RGBA, signed integers,
+    no tifffile, ...), the caller should then fall back to imread + rescale.
+    """
+    try:
+        import tifffile
+    except ImportError:
+        return None
+
+    try:
+        with tifffile.TiffFile(filepath) as tif:
+            series = tif.series[0]
+            arr = series.asarray(out="memmap")
+            if arr.ndim == 3 and series.axes[0] in "SC":
+                arr = np.moveaxis(arr, 0, -1)
+            if not (arr.ndim == 2 or (arr.ndim == 3 and arr.shape[-1] == 3)):
+                return None
+            if not (
+                np.issubdtype(arr.dtype, np.unsignedinteger)
+                or np.issubdtype(arr.dtype, np.floating)
+            ):
+                return None
+            out = _reduce_bands(arr, scale, crop)
+            del arr
+    except Exception:
+        return None
+    return out
+
+
+def _reduce_bands(arr, scale, crop):
+    shape_in = arr.shape[:2]
+    shape_out = [max(1, int(round(n * scale))) for n in shape_in]
+    (top, bottom), (left, right) = crop
+    r_lo, r_hi = int(top), shape_out[0] - int(bottom)
+    c_lo, c_hi = int(left), shape_out[1] - int(right)
+    if r_hi <= r_lo or c_hi <= c_lo:
+        return None
+
+    r_low, r_w, r_f = _sample_grid(shape_in[0], shape_out[0])
+    c_low, c_w, c_f = _sample_grid(shape_in[1], shape_out[1])
+    sigma = (max(0.0, (r_f - 1) / 2), max(0.0, (c_f - 1) / 2))
+    # same as the radius of ndi.gaussian_filter with truncate=4
+    r_pad, c_pad = [int(4.0 * x + 0.5) for x in sigma]
+
+    r_low, r_w = r_low[r_lo:r_hi], r_w[r_lo:r_hi]
+    c_low, c_w = c_low[c_lo:c_hi], c_w[c_lo:c_hi]
+    c0 = max(0, int(c_low[0]) - c_pad)
+    c1 = min(shape_in[1], int(c_low[-1]) + 2 + c_pad)
+
+    out = np.empty((r_hi - r_lo, c_hi - c_lo), dtype=np.float32)
+    for i in range(0, len(r_low), _BAND_ROWS):
+        low, w = r_low[i : i + _BAND_ROWS], r_w[i : i + _BAND_ROWS]
+        # the rows these outputs depend on, and the overlap for the filter;
+        # a band is only cut short at the edges of the image, where
+        # reflect mode is what gaussian_filter does on the full image
+        r0 = max(0, int(low[0]) - r_pad)
+        r1 = min(shape_in[0], int(low[-1]) + 2 + r_pad)
+        band = _to_unit_float(arr[r0:r1, c0:c1])
+        if band.ndim == 3:
+            band = np.dot(band, _GRAY_WEIGHTS)
+        band = ndi.gaussian_filter(band, sigma, mode="reflect")
+        band = _linear(band, low, w, axis=0, offset=r0)
+        out[i : i + len(low)] = _linear(band, c_low, c_w, axis=1, offset=c0)
+    return out
+
+
+def _scale_crop(crop, factor):
+    if isinstance(crop, int) or isinstance(crop, float):
+        return int(round(crop * factor))
+    return tuple(tuple(int(round(c * factor)) for c in side) for side in crop)
+
 
 class ImageDesc:
-    def __init__(self, raw_img, name="<unk>", filename=None):
+    __slots__ = (
+        "_pixels",
+        "_scale",
+        "_offset",
+        "_shape",
+        "name",
+        "filename",
+        "key",
+        "points",
+        "descriptors",
+        "aligned_img",
+        "thumbnail",
+        "_thumb_factor",
+        "_deferred",
+    )
+
+    def __init__(self, raw_img, name="<unk>", filename=None, key=None):
         self.img = raw_img
         self.name = name
         self.filename = filename
+        # cache key in the KeypointStore, if one was used
+        self.key = key
+        # binary descriptors, one per interest point, if extracted
+        self.descriptors = None
+        # small uint8 copy of the pixels, see make_thumbnail
+        self.thumbnail = None
+        self._thumb_factor = 1
+        # attributes computed on first access, see defer
+        self._deferred = {}
+
+    # pixels
+    # img is float32, but can be stored as uint8/uint16 (see compact),
+    # and dropped altogether once nothing needs it (see release_pixels)
+
+    @property
+    def img(self):
+        if self._pixels is None:
+            raise RuntimeError("the pixels of %s were released" % self.name)
+        if self._scale is None:
+            return self._pixels
+        img = self._pixels.astype(np.float32)
+        img *= np.float32(self._scale)
+        img += np.float32(self._offset)
+        return img
+
+    @img.setter
+    def img(self, value):
+        self._pixels = value
+        self._scale = self._offset = None
+        self._shape = None if value is None else tuple(value.shape)
+
+    @property
+    def shape(self):
+        # available even after release_pixels
+        return self._shape
+
+    def compact(self, dtype=np.uint16):
+        """
+        keep the pixels as dtype (uint8 or uint16) between their min and max,
+        img then decodes a float32 copy on every access
+        """
+        if self._pixels is None or self._scale is not None:
+            return
+        img = self._pixels
+        lo, hi = float(img.min()), float(img.max())
+        scale = (hi - lo) / np.iinfo(dtype).max or 1.0
+        pixels = np.empty(img.shape, dtype=dtype)
+        np.rint(
+            (img - np.float32(lo)) / np.float32(scale), out=pixels, casting="unsafe"
+        )
+        self._pixels = pixels
+        self._scale, self._offset = scale, lo
+
+    def release_pixels(self):
+        """
+        drop the pixels (and the aligned images), keeping the points,
+        the descriptors, the shape and the thumbnail
+        """
+        self._pixels = None
+        self._scale = self._offset = None
+        self.forget("aligned_img")
+
+    def make_thumbnail(self, max_side=1024):
+        """
+        uint8 copy of the pixels, block-averaged by an integer factor
+        so that no side is longer than max_side, see thumbnail_extent
+        """
+        img = self.img
+        factor = max(1, -(-max(img.shape) // max_side))
+        rows, cols = img.shape[0] // factor, img.shape[1] // factor
+        blocks = img[: rows * factor, : cols * factor].reshape(
+            rows, factor, cols, factor
+        )
+        thumb = blocks.mean(axis=(1, 3), dtype=np.float32)
+        lo, hi = float(thumb.min()), float(thumb.max())
+        thumb = (thumb - lo) * (255.0 / ((hi - lo) or 1.0))
+        self.thumbnail = np.rint(thumb).astype(np.uint8)
+        self._thumb_factor = factor
+        return self.thumbnail
+
+    def thumbnail_extent(self):
+        """
+        extent for imshow, so that the thumbnail lines up with the points,
+        which are in (row, col) of the full image
+        """
+        rows, cols = self.thumbnail.shape
+        f = self._thumb_factor
+        return (-0.5, cols * f - 0.5, rows * f - 0.5, -0.5)
+
+    # deferred attributes
+
+    def defer(self, name, compute):
+        """
+        compute attribute name on its first access, and only once
+        """
+        self.forget(name)
+        self._deferred[name] = compute
+
+    def forget(self, *names):
+        # drop attributes, computed or deferred, to free their memory
+        for name in names:
+            try:
+                delattr(self, name)
+            except AttributeError:
+                pass
+            self._deferred.pop(name, None)
+
+    def __getattr__(self, name):
+        # only called when name is not set
+        try:
+            deferred = object.__getattribute__(self, "_deferred")
+        except AttributeError:
+            raise AttributeError(name)
+        if name in deferred:
+            value = deferred.pop(name)()
+            setattr(self, name, value)
+            return value
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        # deferred computations hold closures, which do not pickle
+        state = {}
+        for name in self.__slots__:
+            try:
+                state[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        state["_deferred"] = {}
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
 
     @classmethod
     def _from_file(
@@ -25,16 +295,23 @@ class ImageDesc:
         y_flip=False,
     ):
         name = os.path.splitext(os.path.basename(filepath))[0]
-        img = skio.imread(filepath, as_gray=True)
-        if scale != 1.0:
-            img = sktrans.rescale(img, scale, mode="symmetric", anti_aliasing=True)
         if isinstance(crop, int) or isinstance(crop, float):
             cfinal = ((crop, crop), (crop, crop))
         elif isinstance(crop, tuple):
             cfinal = crop
         else:
             raise RuntimeError(f"invalid crop {crop}")
-        img = skutil.crop(img, cfinal, copy=True, order="C")
+
+        img = None
+        if scale < 1.0 and filepath.lower().endswith((".tif", ".tiff")):
+            img = _read_reduced_tiff(filepath, scale, cfinal)
+        if img is None:
+            img = skio.imread(filepath, as_gray=True)
+            if scale != 1.0:
+                img = sktrans.rescale(
+                    img, scale, mode="symmetric", anti_aliasing=True
+                )
+            img = skutil.crop(img, cfinal, copy=True, order="C")
         if y_flip:
             img = np.flip(img, axis=0)
         if x_flip:
@@ -43,8 +320,32 @@ class ImageDesc:
         return ImageDesc(raw_img=img, name=name, filename=filepath)
 
     @classmethod
-    def from_file(cls, filepath, is_k, is_match):
+    def from_file(cls, filepath, is_k, is_match, store=None, scale=None):
+        """
+        read an image with the Config params for its role,
+        scale overrides the configured scale (the crop is scaled along).
+        """
         na1 = "img_K" if is_k else "img_Q"
         na2 = "1" if is_match else "0"
         name = na1 + na2
-        return cls._from_file(filepath, **Config.get_params(name))
+        params = dict(Config.get_params(name))
+        if scale is not None and scale != params["scale"]:
+            params["crop"] = _scale_crop(params["crop"], scale / params["scale"])
+            params["scale"] = scale
+        if store is None:
+            return cls._from_file(filepath, **params)
+
+        # the preprocessed float32 pixels, memory-mapped from the store
+        key = store.image_key(filepath, name, params)
+        hit = store.get_array(key)
+        if hit is not None:
+            return ImageDesc(
+                raw_img=hit,
+                name=os.path.splitext(os.path.basename(filepath))[0],
+                filename=filepath,
+                key=key,
+            )
+        answer = cls._from_file(filepath, **params)
+        store.put_array(key, answer._pixels)
+        answer.key = key
+        return answer
@@ -0,0 +1,221 @@
+"""
+an on-disk store for decoded images and interest points.
+
+each entry is a shard under the store directory: the interest points
+are .npz files, and the decoded images are raw .npy files, which are
+opened memory-mapped (see get_array) so that repeated loads copy
+nothing, and processes that read the same image share its pages
+through the OS page cache.
+
+there is no central index that processes could race on: the mtime of
+a shard is its last access time (a hit touches it), and the store is
+kept under its size limit by scanning the shards after every put and
+evicting the least recently used ones. shards are written to a temporary
+file and renamed, so a reader never sees half a shard, and removing a
+shard that another process is reading does no harm.
+
+keys are sha1 digests that cover
+  * the content of the image file,
+  * the Config params used to read it (img_Q1, img_K1, ...),
+  * and, for interest points, the extractor name and its params.
+
+the content digests are memoized by (path, size, mtime), one small
+file per image under files/.
+
+set SHOECOMP_CACHE_DIR (and optionally SHOECOMP_CACHE_MB)
+to enable the store for the GUI and the batch runner.
+"""
+__all__ = ("KeypointStore", "default_store")
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+
+from _reconfig import Config
+
+_SHARD_EXTS = (".npz", ".npy")
+# seconds after which a temporary file is taken as left behind
+_STALE_TMP = 3600
+
+
+def _digest(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(json.dumps(p, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _atomic_write(path, writer):
+    dirname = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer(f)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class KeypointStore:
+    def __init__(self, root, max_bytes=1 << 30):
+        self.root = os.path.abspath(root)
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.root, exist_ok=True)
+
+    # layout
+    #   <root>/<key[:2]>/<key>.npz|.npy   the shards
+    #   <root>/files/<sha1 of path>.json  memoized content digests
+
+    def _shard_path(self, key, ext=".npz"):
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def _memo_path(self, filepath):
+        name = hashlib.sha1(filepath.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, "files", name + ".json")
+
+    def _shards(self):
+        # (mtime, size, path) of every shard, and of every temporary file
+        # left behind by a writer that died, which goes first
+        stale = time.time() - _STALE_TMP
+        for sub in os.scandir(self.root):
+            if len(sub.name) != 2 or not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                is_tmp = entry.name.endswith(".tmp")
+                if not (is_tmp or entry.name.endswith(_SHARD_EXTS)):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # evicted by another process in the meantime
+                    continue
+                if is_tmp:
+                    if st.st_mtime < stale:
+                        yield 0.0, st.st_size, entry.path
+                    continue
+                yield st.st_mtime, st.st_size, entry.path
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    # keys
+
+    def file_digest(self, filepath):
+        """
+        sha1 of the file content,
+        memoized by (path, size, mtime)
+        """
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        stamp = [st.st_size, st.st_mtime_ns]
+        memo = self._memo_path(filepath)
+        try:
+            with open(memo, "r") as f:
+                known = json.load(f)
+        except (OSError, ValueError):
+            known = None
+        if known is not None and known[:2] == stamp:
+            return known[2]
+
+        h = hashlib.sha1()
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+
+        os.makedirs(os.path.dirname(memo), exist_ok=True)
+        data = json.dumps(stamp + [digest]).encode("utf-8")
+        _atomic_write(memo, lambda f: f.write(data))
+        return digest
+
+    def image_key(self, filepath, role, params=None):
+        if params is None:
+            params = Config.get_params(role)
+        return _digest("img", self.file_digest(filepath), role, params)
+
+    def points_key(self, image_key, extractor, descriptors=False):
+        return _digest(
+            "pts", image_key, extractor._extname_, extractor.get_params(), descriptors
+        )
+
+    # entries
+
+    def get(self, key):
+        path = self._shard_path(key)
+        try:
+            with np.load(path, allow_pickle=False) as z:
+                arrays = {x: z[x] for x in z.files}
+        except (OSError, ValueError):
+            return None
+        self._touch(path)
+        return arrays
+
+    def put(self, key, **arrays):
+        path = self._shard_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, lambda f: np.savez(f, **arrays))
+        self._evict()
+
+    def get_array(self, key, mmap=True):
+        """
+        the array stored by put_array, read-only and memory-mapped
+        unless mmap is False, or None if there is none
+        """
+        path = self._shard_path(key, ".npy")
+        try:
+            arr = np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        self._touch(path)
+        return arr
+
+    def put_array(self, key, arr):
+        """
+        store arr as a raw .npy shard, unless it is larger than
+        a quarter of the store
+        """
+        arr = np.ascontiguousarray(arr)
+        if arr.nbytes > self.max_bytes // 4:
+            # a full-size image that would push most of the store out
+            return
+        path = self._shard_path(key, ".npy")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, lambda f: np.save(f, arr, allow_pickle=False))
+        self._evict()
+
+    def _evict(self):
+        shards = sorted(self._shards())
+        total = sum(x[1] for x in shards)
+        for _, size, path in shards:
+            if total <= self.max_bytes:
+                break
+            total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                # already gone, or still mapped on windows
+                pass
+
+    def clear(self):
+        for _, _, path in list(self._shards()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def default_store():
+    root = os.environ.get("SHOECOMP_CACHE_DIR")
+    if not root:
+        return None
+    max_mb = float(os.environ.get("SHOECOMP_CACHE_MB", 1024))
+    return KeypointStore(root, max_bytes=max_mb * (1 << 20))
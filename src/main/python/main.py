@@ -1,7 +1,9 @@
 from fbs_runtime.application_context.PyQt5 import ApplicationContext
 from PyQt5.QtWidgets import QMainWindow
+from PyQt5.QtCore import QTimer
 
 import sys
+import multiprocessing
 
 from gui import SelWindow
 
@@ -16,10 +18,14 @@ class AppContext(ApplicationContext):
         self.window = SelWindow(ctx=self)
         self.window.setWindowTitle("shoecomp v0.0.0")
         self.window.show()
+        # once the event loop has drawn the window
+        QTimer.singleShot(200, self.window.preload_report)
         return self.app.exec_()
 
 
 if __name__ == "__main__":
+    # the comparison worker is a spawned process, see procworker.py
+    multiprocessing.freeze_support()
     appctxt = AppContext()  # 1. Instantiate ApplicationContext
     exit_code = appctxt.run()  # 2. Invoke appctxt.app.exec_()
     sys.exit(exit_code)
@@ -1,17 +1,38 @@
-import matplotlib
-import skimage.io as skio
 import numpy as np
 
-
-def draw_kde(ax, loader, etor, aligner, metric, score):
-    fname0 = "{}-{}-{}.npy".format(etor, aligner, metric)
-    fname = loader(fname0)
-    subd = np.load(fname, allow_pickle=True)  # ouch
+import refdist
+from _lazy import lazy_import
+
+skio = lazy_import("skimage.io")
+
+
+def _histograms(loader, name):
+    """
+    (counts, edges) of the matches and of the nonmatches,
+    from refdist.bin if there is one, else from the pickled .npy
+    """
+    try:
+        ref = refdist.load(loader(refdist.FILENAME))
+    except (OSError, ValueError):
+        ref = None
+    if ref is not None and name in ref:
+        return tuple(
+            (ref.get(name, x, "hist"), ref.get(name, x, "edges"))
+            for x in ("matches", "nonmatches")
+        )
+    subd = np.load(loader(name + ".npy"), allow_pickle=True)  # ouch
     matches = subd[()]["matches"]
     nonmatches = subd[()]["nonmatches"]
+    return (
+        np.histogram(matches, bins=35, density=False),
+        np.histogram(nonmatches, bins=35, density=False),
+    )
+
 
-    match_hist = np.histogram(matches, bins=35, density=False)
-    nonmatch_hist = np.histogram(nonmatches, bins=35, density=False)
+def draw_kde(ax, loader, etor, aligner, metric, score):
+    match_hist, nonmatch_hist = _histograms(
+        loader, "{}-{}-{}".format(etor, aligner, metric)
+    )
 
     # print(type(ax))
     w = (np.max(match_hist[1]) - np.min(match_hist[1])) / len(match_hist[0])
@@ -63,6 +84,17 @@ def draw_kde(ax, loader, etor, aligner, metric, score):
     ax.set_title("{} score: {}".format(metric, score))
 
 
+def _show(ax, img_desc):
+    # the thumbnail if there is one, drawn over the full-size coordinates
+    # so that the points land in the same places
+    if img_desc.thumbnail is not None:
+        ax.imshow(
+            img_desc.thumbnail, cmap="Greys_r", extent=img_desc.thumbnail_extent()
+        )
+    else:
+        ax.imshow(img_desc.img, cmap="Greys_r")
+
+
 def write_plot(fig, sinfo):
     # print(sinfo)
     gs = fig.add_gridspec(6, 4)
@@ -71,7 +103,7 @@ def write_plot(fig, sinfo):
     k = sinfo["k"]
     corr = sinfo["corr"]
 
-    if q.img.shape[0] < q.img.shape[1]:
+    if q.shape[0] < q.shape[1]:
         qp = fig.add_subplot(gs[0:3, 0:2])
         kp = fig.add_subplot(gs[3:, 0:2])
         urh = fig.add_subplot(gs[2:, 2:])
@@ -94,7 +126,7 @@ def write_plot(fig, sinfo):
     logo.set_xticks([])
     logo.set_yticks([])
 
-    qp.imshow(q.img, cmap="Greys_r")
+    _show(qp, q)
     qp.scatter(
         x=q.points[:, 1],
         y=q.points[:, 0],
@@ -106,7 +138,7 @@ def write_plot(fig, sinfo):
     qp.scatter(x=corr["Q"][:, 1], y=corr["Q"][:, 0], c="red", marker="o", s=5, alpha=1)
     qp.set_title("Q")
 
-    kp.imshow(k.img, cmap="Greys_r")
+    _show(kp, k)
     kp.scatter(
         x=k.points[:, 1],
         y=k.points[:, 0],
@@ -126,6 +158,16 @@ def write_plot(fig, sinfo):
         sinfo["metric"],
         sinfo["score"],
     )
+    cal = sinfo.get("calibration")
+    if cal is not None:
+        urh.set_title(
+            "{} score: {}\n(non-mated percentile {:.1f}, SLR {:.3g})".format(
+                sinfo["metric"],
+                sinfo["score"],
+                cal["nonmatches_percentile"],
+                cal["slr"],
+            )
+        )
 
     fig.suptitle("shoecomp example output")
     fig.subplots_adjust(wspace=0.35, hspace=0.35)
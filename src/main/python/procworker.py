@@ -0,0 +1,169 @@
+"""
+a persistent process for the comparisons of the GUI.
+
+a clique search that runs away cannot be interrupted from a thread,
+so the comparisons run in a separate process instead. the process is
+started once and kept warm: skimage, scipy and cliquematch are imported,
+the extractors are built and the reference distributions are opened
+before the first job arrives.
+
+jobs go in through one queue, and progress events and results come
+back through another (see ComparisonWorker.poll). cancel kills the
+process and starts a fresh one, so the next job finds it warm again.
+"""
+__all__ = ("ComparisonWorker",)
+
+import queue
+import itertools
+import multiprocessing
+
+# the report shows the images at this size at most, so only
+# uint8 thumbnails of Q and K are shipped back to the GUI
+_THUMBNAIL_SIDE = 1024
+
+
+def _preload(refdist_path):
+    # the heavy imports, and everything that can be built before a job
+    import runner  # noqa: F401
+    from _lazy import preload
+    from extractor import EXTRACTOR_MAP
+
+    # importing runner only sets up skimage, scipy and cliquematch
+    # to be imported on first use, see _lazy.py
+    preload()
+
+    extractors = {name: cls() for name, cls in EXTRACTOR_MAP.items()}
+    ref = None
+    if refdist_path:
+        import refdist
+
+        try:
+            ref = refdist.load(refdist_path)
+        except (OSError, ValueError):
+            ref = None
+    return extractors, ref
+
+
+def _serve(jobs, events, refdist_path):
+    from runner import compare_pair
+    from kpstore import default_store
+    from tracing import default_tracer
+
+    extractors, ref = _preload(refdist_path)
+    store = default_store()
+    events.put(("ready", None, None))
+
+    for job_id, params in iter(jobs.get, None):
+
+        def listener(stage, phase, fields, job_id=job_id):
+            events.put(("progress", job_id, (stage, phase, dict(fields))))
+
+        try:
+            with default_tracer("gui", listener=listener, **params) as tracer:
+                res = compare_pair(
+                    store=store,
+                    tracer=tracer,
+                    extractor=extractors.get(params["etor_name"]),
+                    thumbnails=_THUMBNAIL_SIDE,
+                    **params
+                )
+            name = "{}-{}-{}".format(
+                params["etor_name"], params["aligner_name"], params["scorer_name"]
+            )
+            if ref is not None and name in ref:
+                res["calibration"] = ref.lookup(name, res["score"])
+            events.put(("result", job_id, (True, res)))
+        except Exception as e:
+            events.put(("result", job_id, (False, dict(message=str(e)))))
+
+
+class ComparisonWorker:
+    def __init__(self, refdist_path=None):
+        # spawn, so the worker does not inherit the Qt state of the GUI
+        self._ctx = multiprocessing.get_context("spawn")
+        self._ids = itertools.count(1)
+        self.refdist_path = refdist_path
+        self.process = None
+        self.current = None
+        self.start()
+
+    def start(self):
+        self.jobs = self._ctx.Queue()
+        self.events = self._ctx.Queue()
+        self.process = self._ctx.Process(
+            target=_serve,
+            args=(self.jobs, self.events, self.refdist_path),
+            name="shoecomp-worker",
+            daemon=True,
+        )
+        self.process.start()
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def submit(self, **params):
+        """
+        queue a comparison, params are those of runner.compare_pair
+        (q_path, k_path, etor_name, scorer_name, aligner_name, epsilon, alpha).
+        only one job runs at a time: a new one queues behind the running
+        one, and from then on poll drops the events of the older job.
+        call cancel first to stop the running job instead of waiting for it.
+        """
+        if not self.alive():
+            self.start()
+        job_id = next(self._ids)
+        self.current = job_id
+        self.jobs.put((job_id, params))
+        return job_id
+
+    def poll(self):
+        """
+        the events that arrived since the last poll, without blocking,
+        as (kind, job_id, payload) tuples:
+
+          * ("ready", None, None) once the process is warm,
+          * ("progress", job_id, (stage, phase, fields)), see tracing.py,
+          * ("result", job_id, (success, res)), the last event of a job.
+
+        events of jobs that were replaced or cancelled are dropped.
+        """
+        out = []
+        while True:
+            try:
+                kind, job_id, payload = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if job_id is not None and job_id != self.current:
+                continue
+            if kind == "result":
+                self.current = None
+            out.append((kind, job_id, payload))
+
+        if self.current is not None and not self.alive():
+            # the process died under the job, e.g. out of memory
+            message = "the comparison process exited (code %s)" % (
+                self.process.exitcode,
+            )
+            out.append(("result", self.current, (False, dict(message=message))))
+            self.current = None
+            self.start()
+        return out
+
+    def cancel(self):
+        """
+        kill the current job, and start a fresh process for the next one
+        """
+        self.current = None
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+        self.start()
+
+    def close(self):
+        if self.alive():
+            self.jobs.put(None)
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.process = None
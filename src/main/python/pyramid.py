@@ -0,0 +1,180 @@
+"""
+coarse-to-fine matching.
+
+the prints are first matched at a very coarse scale, where the
+correspondence graph is tiny, to get an initial Kabsch transform.
+at every finer scale the interest points are extracted again,
+and only the (Q, K) pairs that agree with the transform from
+the previous level (within tolerance pixels) become vertices
+of the correspondence graph, so every graph stays small.
+
+by default the levels go from a quarter of the configured scale
+to twice it, so the final alignment uses more pixels than a
+single-scale match could afford.
+
+the tolerance is in pixels of the level the transform was fitted at,
+the error of that fit, and grows with the scale in the pixels of the
+next level, so it shrinks with respect to the print as the levels
+get finer.
+"""
+__all__ = ("coarse_to_fine", "align_multiscale", "prescreen")
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from _reconfig import Config
+from imdesc import ImageDesc
+from extractor import EXTRACTOR_MAP
+from corresponder import CORRESPONDER_MAP
+from aligner import KabschMapping, get_alignment_function
+from runner import extract_points, defer_alignment
+
+
+def _base_scale():
+    return Config.get_params("img_Q1")["scale"]
+
+
+def default_scales(levels=3, finest=None):
+    """
+    levels scales, halving from finest (twice the configured scale,
+    at most 1) down
+    """
+    if finest is None:
+        finest = min(1.0, 2 * _base_scale())
+    return tuple(finest / 2 ** i for i in reversed(range(levels)))
+
+
+def _rigid_params(q, k, corr):
+    """
+    3x3 matrix taking K (x, y) to Q (x, y), or None
+    """
+    if corr["size"] < 3:
+        return None
+    map_func = KabschMapping()(q, k, corr)
+    return getattr(map_func, "params", None)
+
+
+def _consistent_vertices(q_pts, k_pts, params, tolerance):
+    """
+    (Q indices, K indices) of the pairs where params takes
+    the K point within tolerance of the Q point
+    """
+    k_xy = np.asarray(k_pts, dtype=np.float64)[:, ::-1]
+    q_xy = np.asarray(q_pts, dtype=np.float64)[:, ::-1]
+    pred = np.matmul(k_xy, params[:2, :2].T) + params[:2, 2]
+    dists = cKDTree(pred).sparse_distance_matrix(
+        cKDTree(q_xy), tolerance, output_type="ndarray"
+    )
+    return dists["j"].astype(np.int64), dists["i"].astype(np.int64)
+
+
+def coarse_to_fine(
+    q_path,
+    k_path,
+    etor_name,
+    epsilon,
+    alpha,
+    scales=None,
+    tolerance=6.0,
+    store=None,
+    **cder_params
+):
+    """
+    match Q and K over increasingly fine scales.
+
+    epsilon, alpha and max_translation are in pixels at the configured
+    scale, and are scaled along with the images. tolerance is in pixels
+    of the level the transform comes from.
+    returns (q, k, cder, corr) at the finest scale,
+    and a list with the details of every level.
+    """
+    if scales is None:
+        scales = default_scales()
+    base = _base_scale()
+    extractor = EXTRACTOR_MAP[etor_name]()
+
+    params = None
+    prev_scale = None
+    levels = []
+    for scale in scales:
+        q = ImageDesc.from_file(
+            q_path, is_k=False, is_match=True, store=store, scale=scale
+        )
+        k = ImageDesc.from_file(
+            k_path, is_k=True, is_match=True, store=store, scale=scale
+        )
+        extract_points(extractor, q, store=store)
+        extract_points(extractor, k, store=store)
+
+        r = scale / base
+        level_cder_params = dict(cder_params)
+        if level_cder_params.get("max_translation") is not None:
+            level_cder_params["max_translation"] *= r
+        cder = CORRESPONDER_MAP["clique2"](
+            epsilon=float(epsilon) * r, alpha=float(alpha) * r, **level_cder_params
+        )
+        vertices = None
+        level_tolerance = None
+        if params is not None:
+            # the same motion, and its error, in the pixels of this level
+            s = scale / prev_scale
+            level_params = params.copy()
+            level_params[:2, 2] *= s
+            level_tolerance = tolerance * s
+            vertices = _consistent_vertices(
+                q.points, k.points, level_params, level_tolerance
+            )
+        corr = cder(q, k, vertices=vertices)
+        if vertices is not None and corr["size"] < 3:
+            # the transform from the previous level did not hold up
+            corr = cder(q, k)
+
+        levels.append(
+            dict(
+                scale=scale,
+                q_pts=len(q.points),
+                k_pts=len(k.points),
+                constrained=vertices is not None,
+                tolerance=level_tolerance,
+                size=corr["size"],
+                graph_V=corr.get("graph_V", 0),
+                graph_E=corr.get("graph_E", 0),
+                time=corr.get("time"),
+            )
+        )
+        next_params = _rigid_params(q, k, corr)
+        if next_params is not None:
+            params, prev_scale = next_params, scale
+
+    return q, k, cder, corr, levels
+
+
+def align_multiscale(
+    q_path, k_path, etor_name, aligner_name, epsilon, alpha, **kwargs
+):
+    """
+    same outputs as runner.align_pair, plus the levels,
+    with the correspondence coming from coarse_to_fine
+    """
+    q, k, cder, corr, levels = coarse_to_fine(
+        q_path, k_path, etor_name, epsilon, alpha, **kwargs
+    )
+    mapping = get_alignment_function(q, k, corr, method_name=aligner_name)
+    map_func = mapping(q, k, corr)
+    defer_alignment(q, k, corr, mapping, map_func)
+    return q, k, cder, corr, map_func, levels
+
+
+def prescreen(q_path, k_path, etor_name, epsilon, alpha, scale=None, **kwargs):
+    """
+    clique fraction of Q and K at a single coarse scale,
+    a cheap first pass before the full comparison (see batch.compare_many)
+    """
+    if scale is None:
+        scale = _base_scale() / 4
+    q, k, cder, corr, levels = coarse_to_fine(
+        q_path, k_path, etor_name, epsilon, alpha, scales=(scale,), **kwargs
+    )
+    if len(q.points) <= 3:
+        return 0.0
+    return corr["size"] / len(q.points)
@@ -0,0 +1,215 @@
+"""
+the reference score distributions in one memory-mapped file.
+
+for every {extractor}-{aligner}-{metric} combination, and for both the
+mated ("matches") and non-mated ("nonmatches") pairs, the file holds
+
+  * the scores, sorted,
+  * a histogram (counts and bin edges),
+  * the ECDF at the bin edges,
+
+all float64, so that a report needs no pickles and no histogramming.
+the layout is
+
+    MAGIC | header length (uint64) | JSON header | padding | float64 data
+
+where the header gives the offset and length of every array in the data.
+the file is opened once per process (see load), and all the arrays are
+views into the memory map.
+
+    python refdist.py convert ../resources/base ../resources/base/refdist.bin
+"""
+__all__ = ("RefDist", "write", "from_npy_dir", "load", "main")
+
+import os
+import sys
+import json
+import struct
+import argparse
+import tempfile
+import numpy as np
+
+MAGIC = b"SHOEREF1"
+FILENAME = "refdist.bin"
+_FIELDS = ("scores", "hist", "edges", "ecdf")
+
+
+def _class_arrays(scores, bins):
+    scores = np.sort(np.asarray(scores, dtype=np.float64).ravel())
+    if len(scores) == 0:
+        edges = np.zeros(bins + 1)
+        return dict(scores=scores, hist=np.zeros(bins), edges=edges, ecdf=edges)
+    hist, edges = np.histogram(scores, bins=bins, density=False)
+    ecdf = np.searchsorted(scores, edges, side="right") / len(scores)
+    return dict(
+        scores=scores, hist=hist.astype(np.float64), edges=edges, ecdf=ecdf
+    )
+
+
+def write(path, dists, bins=35):
+    """
+    write dists, a dict of (extractor, aligner, metric) or name
+    -> (matches, nonmatches), to path
+    """
+    header = dict(bins=bins, entries={})
+    chunks = []
+    offset = 0
+    for key in sorted(dists):
+        name = key if isinstance(key, str) else "-".join(key)
+        entry = header["entries"][name] = {}
+        for label, scores in zip(("matches", "nonmatches"), dists[key]):
+            arrays = _class_arrays(scores, bins)
+            entry[label] = {}
+            for field in _FIELDS:
+                arr = arrays[field]
+                entry[label][field] = [offset, len(arr)]
+                chunks.append(arr)
+                offset += len(arr)
+
+    head = json.dumps(header, sort_keys=True).encode("utf-8")
+    start = len(MAGIC) + 8 + len(head)
+    pad = (-start) % 8
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(head)))
+            f.write(head)
+            f.write(b"\0" * pad)
+            for arr in chunks:
+                f.write(np.ascontiguousarray(arr, dtype="<f8").tobytes())
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def from_npy_dir(dirname):
+    """
+    the distributions in a directory of the older pickled
+    {extractor}-{aligner}-{metric}.npy files, for write
+    """
+    dists = {}
+    for fname in sorted(os.listdir(dirname)):
+        if not fname.endswith(".npy"):
+            continue
+        subd = np.load(os.path.join(dirname, fname), allow_pickle=True)[()]
+        dists[fname[: -len(".npy")]] = (subd["matches"], subd["nonmatches"])
+    return dists
+
+
+class RefDist:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a reference distribution file" % path)
+            (n,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(n).decode("utf-8"))
+        start = len(MAGIC) + 8 + n
+        start += (-start) % 8
+        self.path = path
+        self.bins = header["bins"]
+        self.entries = header["entries"]
+        total = sum(
+            x[field][1]
+            for entry in self.entries.values()
+            for x in entry.values()
+            for field in _FIELDS
+        )
+        if total == 0:
+            self.data = np.zeros(0)
+        else:
+            self.data = np.memmap(
+                path, dtype="<f8", mode="r", offset=start, shape=(total,)
+            )
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def get(self, name, label, field):
+        """
+        one array of name ("ORB-kabsch-ImageNCC"),
+        label ("matches" or "nonmatches") and field
+        ("scores", "hist", "edges" or "ecdf")
+        """
+        offset, n = self.entries[name][label][field]
+        return self.data[offset : offset + n]
+
+    def _density(self, name, label, score):
+        # histogram density at score, with half a count in every bin
+        # so that the ratio stays finite in the tails
+        hist = self.get(name, label, "hist")
+        edges = self.get(name, label, "edges")
+        n = hist.sum() + 0.5 * len(hist)
+        width = max((edges[-1] - edges[0]) / len(hist), 1e-12)
+        i = np.searchsorted(edges, score, side="right") - 1
+        count = hist[i] if 0 <= i < len(hist) else 0.0
+        if score == edges[-1]:
+            count = hist[-1]
+        return (count + 0.5) / (n * width)
+
+    def lookup(self, name, score):
+        """
+        where score falls among the reference scores of name:
+        the fraction of mated and of non-mated scores at or below it
+        (binary searches on the sorted scores), and the score-based
+        likelihood ratio, mated density / non-mated density
+        """
+        out = dict(score=float(score))
+        for label in ("matches", "nonmatches"):
+            scores = self.get(name, label, "scores")
+            pos = np.searchsorted(scores, score, side="right")
+            out[label + "_percentile"] = 100.0 * pos / max(len(scores), 1)
+        out["slr"] = float(
+            self._density(name, "matches", score)
+            / self._density(name, "nonmatches", score)
+        )
+        return out
+
+
+_OPEN = {}
+
+
+def load(path):
+    """
+    the RefDist at path, opened once per process
+    """
+    path = os.path.abspath(path)
+    ref = _OPEN.get(path)
+    if ref is None:
+        ref = _OPEN[path] = RefDist(path)
+    return ref
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="reference distribution files")
+    sub = parser.add_subparsers(dest="command")
+    p_conv = sub.add_parser("convert", help="pack a directory of .npy files")
+    p_conv.add_argument("npy_dir")
+    p_conv.add_argument("out")
+    p_conv.add_argument("--bins", type=int, default=35)
+    p_look = sub.add_parser("lookup", help="percentiles and SLR of a score")
+    p_look.add_argument("path")
+    p_look.add_argument("name", help="e.g. ORB-kabsch-clique_fraction")
+    p_look.add_argument("score", type=float)
+    args = parser.parse_args(argv)
+
+    if args.command == "convert":
+        dists = from_npy_dir(args.npy_dir)
+        write(args.out, dists, bins=args.bins)
+        print("packed %d distributions into %s" % (len(dists), args.out))
+    elif args.command == "lookup":
+        res = load(args.path).lookup(args.name, args.score)
+        for key, value in res.items():
+            print("%s\t%.6f" % (key, value))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
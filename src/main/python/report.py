@@ -0,0 +1,44 @@
+"""
+the report dialog, with everything it needs from matplotlib.
+
+this is imported when the first report is shown (or preloaded once
+the main window is up), so that the window does not wait for it.
+"""
+__all__ = ("MplCanvas", "SuccessDialog")
+
+import matplotlib
+
+matplotlib.use("Qt5Agg")
+
+from matplotlib.backends.backend_qt5agg import (
+    FigureCanvasQTAgg,
+    NavigationToolbar2QT as NavigationToolbar,
+)
+from matplotlib.figure import Figure
+
+import PyQt5.QtWidgets as qtgui
+
+from presenter import write_plot
+
+
+class MplCanvas(FigureCanvasQTAgg):
+    def __init__(self, parent=None, width=14, height=12, dpi=100):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        super(MplCanvas, self).__init__(fig)
+
+
+class SuccessDialog(qtgui.QDialog):
+    # https://www.pythonguis.com/tutorials/plotting-matplotlib/
+    def __init__(self, sinfo, parent):
+        super().__init__(parent)
+
+        self.setWindowTitle("Shoeprint Comparison")
+        sc = MplCanvas(parent=self)
+        write_plot(sc.figure, sinfo)
+
+        toolbar = NavigationToolbar(sc, self)
+
+        layout = qtgui.QVBoxLayout()
+        layout.addWidget(sc)
+        layout.addWidget(toolbar)
+        self.setLayout(layout)
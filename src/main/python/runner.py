@@ -1,6 +1,15 @@
-__all__ = ("runner",)
+__all__ = (
+    "load_image",
+    "extract_points",
+    "defer_alignment",
+    "align_pair",
+    "score_pair",
+    "compare_pair",
+    "WorkerProgress",
+    "TextProgress",
+)
 
-import time
+import sys
 
 from imdesc import ImageDesc
 from extractor import EXTRACTOR_MAP
@@ -10,85 +19,160 @@ from aligner import (
     get_QK_correspondence,
     get_alignment_function,
 )
-from scorer import SCORINGMETHOD_MAP
+from scorer import score_all, needs_of
+from tracing import NULL
 
 
-def _runner(
-    worker, res, k_path, q_path, etor_name, scorer_name, aligner_name, epsilon, alpha
-):
-    # ouch
-    try:
-        worker.debug_text = "loading images"
-        q = ImageDesc.from_file(
-            q_path,
-            is_k=False,
-            is_match=True,
-        )
-        k = ImageDesc.from_file(
-            k_path,
-            is_k=True,
-            is_match=True,
+# the stages of a single Q/K comparison,
+# split out so that headless callers (see batch.py)
+# can run them without a window or a worker
+
+
+def load_image(path, is_k, store=None, tracer=NULL):
+    with tracer.span("load", image="K" if is_k else "Q", path=path) as span:
+        img_desc = ImageDesc.from_file(path, is_k=is_k, is_match=True, store=store)
+        span["shape"] = img_desc.shape
+    return img_desc
+
+
+def _extract(extractor, img, descriptors):
+    if descriptors:
+        return extractor.describe(img)
+    return extractor(img), None
+
+
+def extract_points(extractor, img_desc, store=None, descriptors=False, tracer=NULL):
+    """
+    fill in img_desc.points,
+    and img_desc.descriptors if descriptors is True
+    """
+    with tracer.span(
+        "extract", extractor=extractor._extname_, image=img_desc.name
+    ) as span:
+        span["cached"] = _extract_cached(extractor, img_desc, store, descriptors)
+        span["points"] = len(img_desc.points)
+    return img_desc.points
+
+
+def _extract_cached(extractor, img_desc, store, descriptors):
+    # True if the points came from the store
+    if store is None or img_desc.key is None:
+        img_desc.points, img_desc.descriptors = _extract(
+            extractor, img_desc.img, descriptors
         )
-        worker.percentage = 5
-    except Exception as e:
-        res["message"] = e
         return False
 
-    try:
-        worker.debug_text = "extracting interest points"
-        extractor = EXTRACTOR_MAP[etor_name]()
-        q.points = extractor(q.img)
-        k.points = extractor(k.img)
-        worker.percentage = 25
-        time.sleep(0.5)
-    except Exception as e:
-        res["message"] = e
-        return False
+    key = store.points_key(img_desc.key, extractor, descriptors)
+    hit = store.get(key)
+    if hit is not None:
+        img_desc.points = hit["points"]
+        img_desc.descriptors = hit.get("descriptors")
+        return True
+    img_desc.points, img_desc.descriptors = _extract(
+        extractor, img_desc.img, descriptors
+    )
+    arrays = dict(points=img_desc.points)
+    if descriptors:
+        arrays["descriptors"] = img_desc.descriptors
+    store.put(key, **arrays)
+    return False
 
-    try:
-        worker.debug_text = "aligning impressions"
-        cder = CORRESPONDER_MAP["clique2"](
-            epsilon=float(epsilon), epsilon2=5, alpha=float(alpha)
-        )
-        corr = cder(q, k)
+
+def defer_alignment(q, k, corr, mapping, map_func, needs=None, tracer=NULL):
+    """
+    set up q.aligned_img to be warped on first access,
+    or not at all if needs says no scorer reads it
+    """
+    q.forget("aligned_img")
+    if needs is not None and "aligned_img" not in needs:
+        return
+
+    def warp():
+        with tracer.span("warp", shape=k.shape):
+            return mapping.align_Q_to_K(q, k, corr, map_func=map_func)
+
+    q.defer("aligned_img", warp)
+
+
+def align_pair(
+    q,
+    k,
+    aligner_name,
+    epsilon,
+    alpha,
+    cder_name="clique2",
+    needs=None,
+    tracer=NULL,
+    **cder_params
+):
+    cder = CORRESPONDER_MAP[cder_name](
+        epsilon=float(epsilon), epsilon2=5, alpha=float(alpha), **cder_params
+    )
+    with tracer.span("correspond", corresponder=cder_name) as span:
+        # only for this call, cder goes into the results
+        cder.tracer = tracer
+        try:
+            corr = cder(q, k)
+        finally:
+            del cder.tracer
+        span["size"] = corr["size"]
+    with tracer.span("fit", aligner=aligner_name):
         mapping = get_alignment_function(q, k, corr, method_name=aligner_name)
         map_func = mapping(q, k, corr)
-        q.aligned_img = mapping.align_Q_to_K(q, k, corr, map_func=map_func)
-        worker.percentage = 75
-        time.sleep(0.5)
-    except Exception as e:
-        res["message"] = e
-        return False
+    defer_alignment(q, k, corr, mapping, map_func, needs=needs, tracer=tracer)
+    return cder, corr, map_func
 
-    try:
-        worker.debug_text = "calculating similarity"
-        scor = SCORINGMETHOD_MAP[scorer_name](
-            Q=q, K=k, corr=corr, map_func=map_func, epsilon=5
-        )
-        point = scor()
-        worker.percentage = 85
-        time.sleep(0.5)
-    except Exception as e:
-        res["message"] = e
-        return False
 
-    try:
-        worker.debug_text = "creating report"
-        worker.percentage = 95
-        time.sleep(0.5)
-    except Exception as e:
-        res["message"] = e
-        return False
+def score_pair(q, k, corr, map_func, scorer_name, tracer=NULL):
+    with tracer.span("score", metric=scorer_name):
+        return score_all(q, k, corr, map_func, metrics=[scorer_name])[scorer_name]
 
-    while worker.percentage < 100:
-        worker.percentage += 1
-        time.sleep(0.05)
 
-    res["q"] = q
-    res["k"] = k
-    res["cder"] = cder
-    res["corr"] = corr
-    details = {
+def compare_pair(
+    q_path,
+    k_path,
+    etor_name,
+    scorer_name,
+    aligner_name,
+    epsilon,
+    alpha,
+    store=None,
+    tracer=NULL,
+    extractor=None,
+    thumbnails=None,
+):
+    """
+    one full comparison of Q and K, as a dict of results.
+    progress is reported through the tracer's listeners.
+    extractor is an already built EXTRACTOR_MAP[etor_name]().
+    if thumbnails is a size in pixels, Q and K come back with
+    thumbnails of at most that side, and without their pixels.
+    """
+    q = load_image(q_path, is_k=False, store=store, tracer=tracer)
+    k = load_image(k_path, is_k=True, store=store, tracer=tracer)
+    if extractor is None:
+        extractor = EXTRACTOR_MAP[etor_name]()
+    extract_points(extractor, q, store=store, tracer=tracer)
+    extract_points(extractor, k, store=store, tracer=tracer)
+    cder, corr, map_func = align_pair(
+        q,
+        k,
+        aligner_name,
+        epsilon,
+        alpha,
+        needs=needs_of(scorer_name),
+        tracer=tracer,
+    )
+    point = score_pair(q, k, corr, map_func, scorer_name, tracer=tracer)
+    if thumbnails is not None:
+        for x in (q, k):
+            x.make_thumbnail(thumbnails)
+            x.release_pixels()
+    return {
+        "q": q,
+        "k": k,
+        "cder": cder,
+        "corr": corr,
         "extractor": etor_name,
         "q_pts": len(q.points),
         "k_pts": len(k.points),
@@ -99,33 +183,79 @@ def _runner(
         "eps1": epsilon,
         "alpha": alpha,
     }
-    res.update(details)
-
-    return True
-
-
-def runner(window, worker):
-    worker.start()
-    res = dict(message="")
-
-    k_path = window.file1.text()
-    q_path = window.file2.text()
-    etor_name = window.point_options.currentText()
-    aligner_name = window.align_options.currentText()
-    scorer_name = window.score_options.currentText()
-    epsilon = window.clique_eps.text()
-    alpha = window.clique_alpha.text()
-
-    window.success = _runner(
-        worker=worker,
-        res=res,
-        k_path=k_path,
-        q_path=q_path,
-        etor_name=etor_name,
-        aligner_name=aligner_name,
-        scorer_name=scorer_name,
-        epsilon=epsilon,
-        alpha=alpha,
-    )
-    window.sinfo = res
-    worker.finish()
+
+
+# what the stages say when they start,
+# and how far along (percent) the comparison is when they end
+_STAGE_TEXT = {
+    "load": "loading images",
+    "extract": "extracting interest points",
+    "thin": "thinning interest points",
+    "graph": "building the correspondence graph",
+    "clique": "searching for the maximum clique",
+    "fit": "fitting the alignment",
+    "warp": "aligning impressions",
+    "score": "calculating similarity",
+}
+_STAGE_DONE = {
+    "load": 5,
+    "extract": 25,
+    "thin": 30,
+    "graph": 40,
+    "correspond": 75,
+    "fit": 80,
+    "warp": 90,
+    "score": 98,
+}
+
+
+class WorkerProgress:
+    """
+    tracer listener that drives the progress bar and text of a GUI worker
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def _advance(self, value):
+        # stages repeat (two images, ...), so never go back
+        self.worker.percentage = max(self.worker.percentage, int(value))
+
+    def __call__(self, stage, phase, fields):
+        if phase == "start" and stage in _STAGE_TEXT:
+            self.worker.debug_text = _STAGE_TEXT[stage]
+        elif phase == "end":
+            if stage == "graph" and "V" in fields:
+                self.worker.debug_text = "graph has %d vertices, %d edges" % (
+                    fields["V"],
+                    fields["E"],
+                )
+            if stage in _STAGE_DONE:
+                self._advance(_STAGE_DONE[stage])
+        elif stage == "clique_progress":
+            self.worker.debug_text = "largest clique so far: %d (at most %d)" % (
+                fields["size"],
+                fields["ub"],
+            )
+            lo, hi = _STAGE_DONE["graph"], _STAGE_DONE["correspond"]
+            self._advance(lo + (hi - lo) * fields["size"] / max(fields["ub"], 1))
+
+
+class TextProgress:
+    """
+    tracer listener that prints the end of every stage, for headless runs
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stderr
+
+    def __call__(self, stage, phase, fields):
+        if phase == "start":
+            return
+        info = ", ".join(
+            "%s=%s" % (x, fields[x])
+            for x in ("points", "V", "E", "size", "ub", "metric")
+            if x in fields
+        )
+        took = " (%.3fs)" % fields["duration"] if "duration" in fields else ""
+        print("%s%s %s" % (stage, took, info), file=self.stream)
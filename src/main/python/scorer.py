@@ -1,12 +1,257 @@
+import os
+
 from imdesc import ImageDesc
 from extractor import EXTRACTOR_MAP
 
-import skimage.feature as skfeat
 import numpy as np
+from collections import OrderedDict
+from _lazy import lazy_import
+
+spfft = lazy_import("scipy.fft")
+spatial = lazy_import("scipy.spatial")
+
+
+def _nbytes(value):
+    if isinstance(value, tuple):
+        return sum(_nbytes(x) for x in value)
+    return getattr(value, "nbytes", 0)
+
+
+class _LRUCache:
+    def __init__(self, maxsize=32, max_bytes=None):
+        self.maxsize = maxsize
+        # None for no limit on the arrays held, 0 to cache nothing
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key, compute):
+        if key is None or self.max_bytes == 0:
+            return compute()
+        if key in self.data:
+            self.data.move_to_end(key)
+            return self.data[key]
+        value = compute()
+        self.data[key] = value
+        self.nbytes += _nbytes(value)
+        self._trim()
+        return value
+
+    def limit(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._trim()
+
+    def _trim(self):
+        while self.data and (
+            len(self.data) > self.maxsize
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            self.nbytes -= _nbytes(self.data.popitem(last=False)[1])
+
+
+def _image_key(img_desc):
+    """
+    a key that identifies the pixels of img_desc across calls,
+    or None if there is nothing better than id(), which can be reused.
+    a store key covers the file content; a bare filename is only
+    good with the size and mtime of the file, which can change in place
+    """
+    key = getattr(img_desc, "key", None)
+    if key is not None:
+        return (key, img_desc.shape)
+    filename = getattr(img_desc, "filename", None)
+    if filename is None:
+        return None
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (filename, st.st_size, st.st_mtime_ns, img_desc.shape)
+
+
+def _nearest(tree, pts):
+    """
+    distance to and index of the nearest tree point for every point,
+    taking the lowest index among equally near points, like np.argmin
+    """
+    k = min(4, tree.n)
+    dist, idx = tree.query(pts, k=k)
+    if k == 1:
+        return dist, idx
+    tied = dist == dist[:, :1]
+    best_dist, best = dist[:, 0], np.where(tied, idx, tree.n).min(axis=1)
+    if k == tree.n:
+        return best_dist, best
+    # all k neighbours tied, there may be more of them beyond k:
+    # look at every tree point within that distance, like a full argmin
+    for i in np.nonzero(tied[:, -1])[0]:
+        near = np.array(tree.query_ball_point(pts[i], best_dist[i] * (1 + 1e-9)))
+        d = np.sqrt(((tree.data[near] - pts[i]) ** 2).sum(axis=1))
+        best[i] = near[d == d.min()].min()
+    return best_dist, best
+
+
+def match_points(Q_tree, Q_pts, K_pts, max_distance):
+    """
+    the same (Q index, K index) pairs as
+    skimage.feature.match_descriptors(Q_pts, K_pts, metric="euclidean",
+    max_distance=max_distance, cross_check=True),
+    with KD-trees instead of the dense |Q| x |K| distance matrix
+    """
+    if len(Q_pts) == 0 or len(K_pts) == 0:
+        return np.zeros((0, 2), dtype=np.intp)
+    dist, idx2 = _nearest(spatial.cKDTree(K_pts), Q_pts)
+    _, idx1 = _nearest(Q_tree, K_pts)
+    idx = np.arange(len(Q_pts))
+    mask = (idx1[idx2] == idx) & (dist < max_distance)
+    return np.column_stack((idx[mask], idx2[mask]))
+
+
+def _points_key(img_desc):
+    key = _image_key(img_desc)
+    if key is None:
+        return None
+    return key + (len(img_desc.points), hash(img_desc.points.tobytes()))
+
+
+_QTREES = _LRUCache(32)
+
+
+def _points_tree(img_desc):
+    # KD-tree over the (x, y) points of img_desc, built once per Q
+    return _QTREES.get(
+        _points_key(img_desc), lambda: spatial.cKDTree(img_desc.points[:, ::-1])
+    )
+
+
+class POCEngine:
+    """
+    phase-only correlation with cached spectra.
+
+    the FFT of every K image is kept in an LRU cache, and a stack of
+    aligned images is transformed in a single multi-threaded scipy.fft
+    call. pocketfft keeps its plans between calls, so repeated shapes
+    do not pay for planning again.
+
+    the numbers are those of the original POC_R, which the reference
+    distributions were computed with: float64 full spectra, and irfft2
+    of the whole normalized cross-power spectrum.
+    """
+
+    def __init__(self, maxsize=32, max_bytes=128 << 20, workers=-1):
+        self.cache = _LRUCache(maxsize, max_bytes)
+        self.workers = workers
+
+    def _fft(self, imgs):
+        return spfft.fft2(
+            np.asarray(imgs, dtype=np.float64), axes=(-2, -1), workers=self.workers
+        )
+
+    def spectrum(self, img_desc):
+        return self.cache.get(_image_key(img_desc), lambda: self._fft(img_desc.img))
+
+    def _peaks(self, aligned, k_spec):
+        cross = self._fft(aligned)
+        cross *= np.conj(k_spec)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cross /= np.abs(cross)
+        score = spfft.irfft2(cross, axes=(-2, -1), workers=self.workers)
+        return score.reshape(score.shape[:-2] + (-1,)).max(axis=-1)
+
+    def score(self, aligned_img, k_desc):
+        return float(self._peaks(aligned_img, self.spectrum(k_desc)))
+
+    def score_many(self, aligned_imgs, k_descs):
+        """
+        POC scores of every aligned image against its K
+        (k_descs is one K for all of them, or one K per image).
+        images against the same K go through one batched FFT.
+        """
+        if not isinstance(k_descs, (list, tuple)):
+            k_descs = [k_descs] * len(aligned_imgs)
+        scores = np.zeros(len(aligned_imgs), dtype=np.float64)
+        groups = OrderedDict()
+        for i, k in enumerate(k_descs):
+            groups.setdefault(id(k), []).append(i)
+        for idx in groups.values():
+            k = k_descs[idx[0]]
+            stack = np.stack([aligned_imgs[i] for i in idx])
+            scores[idx] = self._peaks(stack, self.spectrum(k))
+        return scores
+
+
+_POC = POCEngine()
+
+
+def set_spectrum_cache(max_bytes):
+    """
+    limit the memory of the cached K spectra (0 to cache none),
+    e.g. in batch workers, which see every K only once
+    """
+    _POC.cache.limit(max_bytes)
+
+
+def _dot64(a, b):
+    # sum(a * b) accumulated in float64 without float64 copies of a and b
+    a, b = np.asarray(a), np.asarray(b)
+    return float(np.einsum("i,i->", a.ravel(), b.ravel(), dtype=np.float64))
+
+
+def _moments(a):
+    # mean and standard deviation in float64, from sum(a) and sum(a * a);
+    # a variance within rounding of mean**2 is that of a constant image
+    a = np.asarray(a)
+    mean = float(np.sum(a, dtype=np.float64)) / a.size
+    var = _dot64(a, a) / a.size - mean * mean
+    if var <= 1e-12 * mean * mean:
+        return mean, 0.0
+    return mean, np.sqrt(var)
+
+
+class NCCEngine:
+    """
+    normalized cross-correlation of the warped Q and K.
+
+    the mean and standard deviation of every K are computed once and
+    cached (two floats per K), so a score needs one dot product and the
+    statistics of the aligned image. the images stay float32, the sums
+    are accumulated in float64, so the numbers are those of the original
+    NCC, mean(normalize(Q) * normalize(K)) over the whole image in
+    float64, which the reference distributions were computed with.
+    """
+
+    def __init__(self, maxsize=256):
+        self.cache = _LRUCache(maxsize)
+
+    def _k_stats(self, k_desc):
+        return self.cache.get(_image_key(k_desc), lambda: _moments(k_desc.img))
+
+    def score(self, aligned_img, k_desc):
+        mean_k, std_k = self._k_stats(k_desc)
+        mean_q, std_q = _moments(aligned_img)
+        if std_q == 0 or std_k == 0:
+            return 0.0
+        cov = _dot64(aligned_img, k_desc.img) / np.size(aligned_img)
+        return (cov - mean_q * mean_k) / (std_q * std_k)
+
+    def score_many(self, aligned_imgs, k_descs):
+        """
+        NCC of every aligned image against its K
+        (k_descs is one K for all of them, or one K per image)
+        """
+        if not isinstance(k_descs, (list, tuple)):
+            k_descs = [k_descs] * len(aligned_imgs)
+        return np.array([self.score(q, k) for q, k in zip(aligned_imgs, k_descs)])
+
+
+_NCC = NCCEngine()
 
 
 class ScoringMethod:
     _extname_ = "<unk>"
+    # which inputs __call__ reads: any of
+    # "points", "corr", "map_func", "aligned_img"
+    needs = frozenset(("points", "corr", "map_func", "aligned_img"))
 
     def __init__(self, Q, K, corr, map_func, *args, **params):
         self.Q = Q
@@ -20,6 +265,7 @@ class ScoringMethod:
 
 class CliqueFraction(ScoringMethod):
     _extname_ = "clique_fraction"
+    needs = frozenset(("points", "corr"))
 
     def __call__(self):
         if len(self.Q.points) <= 3:
@@ -31,20 +277,39 @@ class CliqueFraction(ScoringMethod):
 
 class MedianDistance(ScoringMethod):
     _extname_ = "median_distance"
+    needs = frozenset(("points", "map_func"))
 
     def __init__(self, Q, K, corr, map_func, epsilon):
         super().__init__(Q, K, corr, map_func, epsilon)
         self.epsilon = epsilon
 
+    @staticmethod
+    def score_many(Q, Ks, map_funcs, epsilon):
+        """
+        median distance scores of many K point sets against one Q,
+        sharing one KD-tree over Q
+        """
+        if len(Q.points) <= 3:
+            return np.zeros(len(Ks))
+        Q_tree = spatial.cKDTree(Q.points[:, ::-1])
+        return np.array(
+            [
+                MedianDistance(Q, K, None, f, epsilon).score(Q_tree)
+                for K, f in zip(Ks, map_funcs)
+            ]
+        )
+
     def __call__(self):
         if len(self.Q.points) <= 3:
             return 0
+        return self.score(_points_tree(self.Q))
+
+    def score(self, Q_tree):
+        # Q_tree is the KD-tree over the (x, y) points of Q
         Q_pts = self.Q.points[:, ::-1]
         K_pts = self.K.points[:, ::-1]
         K_pts_in_Q_space = self.map_func(K_pts)
-        indices = skfeat.match_descriptors(
-            Q_pts, K_pts_in_Q_space, metric="euclidean", max_distance=self.epsilon
-        )
+        indices = match_points(Q_tree, Q_pts, K_pts_in_Q_space, self.epsilon)
 
         Q_close = Q_pts[indices[:, 0]]
         K_close = K_pts_in_Q_space[indices[:, 1]]
@@ -55,6 +320,7 @@ class MedianDistance(ScoringMethod):
 
 class NCC(ScoringMethod):
     _extname_ = "ImageNCC"
+    needs = frozenset(("aligned_img",))
 
     @staticmethod
     def normalize(x):
@@ -64,24 +330,20 @@ class NCC(ScoringMethod):
         return (x - np.mean(x)) / std
 
     def __call__(self):
-        q_img = NCC.normalize(self.Q.aligned_img)
-        k_img = NCC.normalize(self.K.img)
-        return np.mean(q_img * k_img)
+        return _NCC.score(self.Q.aligned_img, self.K)
 
 
 class POC_R(ScoringMethod):
     _extname_ = "ImagePOC"
+    needs = frozenset(("aligned_img",))
 
     def __call__(self):
-        freq_space = np.fft.fft2(self.Q.aligned_img) * np.conj(np.fft.fft2(self.K.img))
-        freq_space = freq_space / np.abs(freq_space)
-        score = np.fft.irfft2(freq_space)  # imaginary part is ZERO
-        result = np.max(score)
-        return result
+        return _POC.score(self.Q.aligned_img, self.K)
 
 
 class CliqueSize(ScoringMethod):
     _extname_ = "clique_size"
+    needs = frozenset(("points", "corr"))
 
     def __call__(self):
         if len(self.Q.points) <= 3:
@@ -93,3 +355,39 @@ class CliqueSize(ScoringMethod):
 
 
 SCORINGMETHOD_MAP = {x._extname_: x for x in ScoringMethod.__subclasses__()}
+
+
+def _metric_names(metrics):
+    if metrics is None or metrics == "all":
+        return list(SCORINGMETHOD_MAP.keys())
+    if isinstance(metrics, str):
+        return [metrics]
+    return list(metrics)
+
+
+def needs_of(metrics):
+    """
+    the inputs read by any of metrics (a name, a list of names, or "all")
+    """
+    needs = set()
+    for name in _metric_names(metrics):
+        needs |= SCORINGMETHOD_MAP[name].needs
+    return frozenset(needs)
+
+
+def score_all(Q, K, corr, map_func, metrics=None, epsilon=5):
+    """
+    scores of Q against K for every metric in metrics
+    (a name, a list of names, or "all", the default),
+    as an OrderedDict of name -> score.
+
+    everything the metrics share is computed once: the aligned image
+    is an attribute of Q, computed on first access, the KD-tree over Q
+    and the spectrum and statistics of K live in the caches of this module.
+    """
+    scores = OrderedDict()
+    for name in _metric_names(metrics):
+        scores[name] = SCORINGMETHOD_MAP[name](
+            Q=Q, K=K, corr=corr, map_func=map_func, epsilon=epsilon
+        )()
+    return scores
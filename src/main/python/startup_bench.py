@@ -0,0 +1,130 @@
+"""
+how long the application takes to import, for keeping startup fast.
+
+every target is imported in a fresh interpreter (several times, the
+median is reported), and once more to list the modules that took
+longest: with python -X importtime on 3.7+, and on 3.6, which has no
+-X importtime, by timing the import statements from inside the
+interpreter (see _TIMED_IMPORTS), which adds a little overhead.
+the targets are the GUI (without showing a window), the registries,
+and everything a comparison needs.
+
+    python startup_bench.py --repeat 5 --top 15
+"""
+__all__ = ("TARGETS", "time_import", "main")
+
+import os
+import sys
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+TARGETS = {
+    "gui": "import gui",
+    "registries": "import extractor, aligner, scorer, corresponder",
+    "comparison": "import runner, _lazy; _lazy.preload()",
+}
+
+
+# writes the same lines as -X importtime, for pythons without it.
+# only the first import of a module is timed, like -X importtime does
+_TIMED_IMPORTS = r"""
+import sys, time, builtins, importlib
+_stack = []
+def _timed(orig, relative):
+    def timed(name, *args, **kwargs):
+        if relative(args, kwargs) or name in sys.modules:
+            return orig(name, *args, **kwargs)
+        _stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return orig(name, *args, **kwargs)
+        finally:
+            cum = time.perf_counter() - start
+            inner = _stack.pop()
+            if _stack:
+                _stack[-1] += cum
+            sys.stderr.write(
+                "import time: %d | %d | %s\n"
+                % ((cum - inner) * 1e6, cum * 1e6, name)
+            )
+    return timed
+builtins.__import__ = _timed(
+    builtins.__import__,
+    lambda a, k: (a[3] if len(a) > 3 else k.get("level", 0)) > 0,
+)
+importlib.import_module = _timed(
+    importlib.import_module, lambda a, k: False
+)
+"""
+
+
+def _run(code, importtime=False):
+    cmd = [sys.executable]
+    prelude = ""
+    if importtime and sys.version_info >= (3, 7):
+        cmd += ["-X", "importtime"]
+    elif importtime:
+        prelude = _TIMED_IMPORTS
+    cmd += [
+        "-c",
+        prelude + "import time; _t = time.perf_counter(); %s; "
+        "print(time.perf_counter() - _t)" % code,
+    ]
+    proc = subprocess.run(
+        cmd,
+        cwd=HERE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    return float(proc.stdout.strip().splitlines()[-1]), proc.stderr
+
+
+def _slowest(importtime_log, top):
+    # lines look like "import time: self [us] | cumulative | imported package"
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cum_us, name = [x.strip() for x in line.split(":", 1)[1].split("|")]
+        rows.append((int(cum_us), int(self_us), name))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+
+def time_import(code, repeat=5):
+    """
+    median seconds to run code in a fresh interpreter
+    """
+    times = sorted(_run(code)[0] for _ in range(repeat))
+    return times[len(times) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="time the imports at startup")
+    parser.add_argument(
+        "targets", nargs="*", default=list(TARGETS.keys()), choices=list(TARGETS)
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    for name in args.targets:
+        try:
+            median = time_import(TARGETS[name], repeat=args.repeat)
+            _, log = _run(TARGETS[name], importtime=True)
+        except RuntimeError as e:
+            print("%s: failed, %s" % (name, e))
+            continue
+        print("%s: %.3fs (median of %d)" % (name, median, args.repeat))
+        for cum_us, self_us, module in _slowest(log, args.top):
+            print("  %8.1f ms  %s" % (cum_us / 1000.0, module))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+"""
+parameter sweeps over extractor, epsilon, alpha, aligner and scorer.
+
+every (Q, K) pair goes through the stages of a comparison as a tree,
+so that no stage runs twice for the same inputs:
+
+    load Q, K
+      extract points          once per extractor
+        thin points           once per alpha
+          clique search       once per (alpha, epsilon)
+            align             once per aligner
+              score           all the metrics in one pass
+
+the pairs are spread over a process pool, and the rows of every pair
+are appended to a CSV file as soon as the pair is done. a sweep that
+was interrupted picks up where it stopped: pairs that already have
+all their rows in the file are skipped.
+
+    python sweep.py pairs.csv results.csv --extractor ORB CENSURE \\
+        --epsilon 0.5 1 --alpha 5 10 --aligner kabsch --scorer all
+
+pairs.csv has a header with (at least) the columns q and k.
+"""
+__all__ = ("FIELDS", "make_grid", "sweep_pair", "sweep", "read_pairs", "main")
+
+import os
+import sys
+import csv
+import argparse
+import multiprocessing
+from collections import OrderedDict
+
+from imdesc import ImageDesc
+from extractor import EXTRACTOR_MAP
+from corresponder import CORRESPONDER_MAP, thin_indices
+from aligner import ALIGNER_MAP, get_alignment_function
+from scorer import SCORINGMETHOD_MAP, score_all, needs_of
+from kpstore import KeypointStore, default_store
+from runner import load_image, extract_points, defer_alignment
+
+FIELDS = (
+    "q_path",
+    "k_path",
+    "extractor",
+    "eps1",
+    "alpha",
+    "alignment",
+    "metric",
+    "score",
+    "clique_size",
+    "q_pts",
+    "k_pts",
+    "time",
+    "success",
+    "message",
+)
+
+
+def make_grid(extractors, epsilons, alphas, aligners, metrics="all"):
+    if metrics == "all":
+        metrics = list(SCORINGMETHOD_MAP.keys())
+    return OrderedDict(
+        extractors=list(extractors),
+        epsilons=[float(x) for x in epsilons],
+        alphas=[float(x) for x in alphas],
+        aligners=list(aligners),
+        metrics=list(metrics),
+    )
+
+
+def _combos(grid):
+    for etor_name in grid["extractors"]:
+        for alpha in grid["alphas"]:
+            for epsilon in grid["epsilons"]:
+                for aligner_name in grid["aligners"]:
+                    for metric in grid["metrics"]:
+                        yield etor_name, epsilon, alpha, aligner_name, metric
+
+
+def _row_key(q_path, k_path, etor_name, epsilon, alpha, aligner_name, metric):
+    return (
+        q_path,
+        k_path,
+        etor_name,
+        float(epsilon),
+        float(alpha),
+        aligner_name,
+        metric,
+    )
+
+
+def _pair_keys(q_path, k_path, grid):
+    return set(_row_key(q_path, k_path, *x) for x in _combos(grid))
+
+
+def _failed_rows(q_path, k_path, grid, message, **fixed):
+    # one row per combination that agrees with the fixed stages
+    names = ("extractor", "eps1", "alpha", "alignment", "metric")
+    for combo in _combos(grid):
+        row = dict(zip(names, combo))
+        if any(row[x] != fixed[x] for x in fixed):
+            continue
+        row.update(q_path=q_path, k_path=k_path, success=False, message=message)
+        yield row
+
+
+def _thinned(img_desc, alpha):
+    # only the points that clique2 would keep for alpha, no pixels
+    ind = thin_indices(img_desc.points, max(0.0, alpha))
+    thin = ImageDesc(None, img_desc.name, img_desc.filename, img_desc.key)
+    thin.points = img_desc.points[ind]
+    if img_desc.descriptors is not None:
+        thin.descriptors = img_desc.descriptors[ind]
+    return thin
+
+
+def sweep_pair(q_path, k_path, grid, store=None, **cder_params):
+    """
+    every combination of grid for one pair, as a list of row dicts.
+
+    the clique search is clique1 on points thinned by alpha,
+    which is what clique2 does for a single (epsilon, alpha),
+    and the scores are computed on the full Q and K like in runner.py.
+    any other keyword arguments go to the clique matcher.
+    """
+    rows = []
+    needs = needs_of(grid["metrics"])
+    try:
+        q = load_image(q_path, is_k=False, store=store)
+        k = load_image(k_path, is_k=True, store=store)
+    except Exception as e:
+        return list(_failed_rows(q_path, k_path, grid, str(e)))
+
+    for etor_name in grid["extractors"]:
+        try:
+            extractor = EXTRACTOR_MAP[etor_name]()
+            want_desc = cder_params.get("top_m") is not None
+            extract_points(extractor, q, store=store, descriptors=want_desc)
+            extract_points(extractor, k, store=store, descriptors=want_desc)
+        except Exception as e:
+            rows.extend(
+                _failed_rows(q_path, k_path, grid, str(e), extractor=etor_name)
+            )
+            continue
+
+        for alpha in grid["alphas"]:
+            q_thin, k_thin = _thinned(q, alpha), _thinned(k, alpha)
+            for epsilon in grid["epsilons"]:
+                cder = CORRESPONDER_MAP["clique1"](epsilon=epsilon, **cder_params)
+                corr = cder(q_thin, k_thin)
+                for aligner_name in grid["aligners"]:
+                    fixed = dict(
+                        extractor=etor_name,
+                        eps1=epsilon,
+                        alpha=alpha,
+                        alignment=aligner_name,
+                    )
+                    try:
+                        mapping = get_alignment_function(
+                            q, k, corr, method_name=aligner_name
+                        )
+                        map_func = mapping(q, k, corr)
+                        defer_alignment(q, k, corr, mapping, map_func, needs=needs)
+                        scores = score_all(
+                            q, k, corr, map_func, metrics=grid["metrics"]
+                        )
+                    except Exception as e:
+                        rows.extend(
+                            _failed_rows(q_path, k_path, grid, str(e), **fixed)
+                        )
+                        continue
+                    finally:
+                        q.forget("aligned_img")
+                    for metric, score in scores.items():
+                        rows.append(
+                            dict(
+                                fixed,
+                                q_path=q_path,
+                                k_path=k_path,
+                                metric=metric,
+                                score=score,
+                                clique_size=corr["size"],
+                                q_pts=len(q.points),
+                                k_pts=len(k.points),
+                                time=corr.get("time"),
+                                success=True,
+                                message="",
+                            )
+                        )
+    return rows
+
+
+# per-process state, filled in by _init_worker
+_STATE = {}
+
+
+def _init_worker(grid, store, cder_params):
+    _STATE.update(grid=grid, store=store, cder_params=cder_params)
+
+
+def _sweep_one(pair):
+    return sweep_pair(
+        pair[0], pair[1], _STATE["grid"], _STATE["store"], **_STATE["cder_params"]
+    )
+
+
+def _drop_partial_row(out_path, chunk=1 << 16):
+    """
+    truncate out_path after its last newline, so that a row cut short
+    by an interruption is not continued by the next append
+    """
+    if not os.path.exists(out_path):
+        return
+    with open(out_path, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - chunk)
+            f.seek(start)
+            i = f.read(pos - start).rfind(b"\n")
+            if i >= 0:
+                pos = start + i + 1
+                break
+            pos = start
+        if pos < end:
+            f.truncate(pos)
+
+
+def _read_done(out_path):
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                done.add(
+                    _row_key(
+                        row["q_path"],
+                        row["k_path"],
+                        row["extractor"],
+                        row["eps1"],
+                        row["alpha"],
+                        row["alignment"],
+                        row["metric"],
+                    )
+                )
+            except (KeyError, TypeError, ValueError):
+                # a row cut short by an interruption
+                continue
+    return done
+
+
+def sweep(pairs, grid, out_path, workers=None, store=None, **cder_params):
+    """
+    run sweep_pair over the (q_path, k_path) pairs, appending
+    the rows to the CSV file out_path, and yield each pair's rows
+    as soon as it is done. pairs with all their rows already
+    in out_path are skipped, and a last row left unfinished
+    by an interrupted run is dropped and computed again.
+    """
+    if store is None:
+        store = default_store()
+    _drop_partial_row(out_path)
+    done = _read_done(out_path)
+    todo = [x for x in pairs if not _pair_keys(x[0], x[1], grid) <= done]
+    if not todo:
+        return
+
+    new_file = not os.path.exists(out_path) or os.path.getsize(out_path) == 0
+    initargs = (grid, store, cder_params)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(todo)))
+
+    with open(out_path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if new_file:
+            writer.writeheader()
+            f.flush()
+
+        def write(rows):
+            rows = [
+                x
+                for x in rows
+                if _row_key(*(x[y] for y in FIELDS[:7])) not in done
+            ]
+            writer.writerows(rows)
+            f.flush()
+            return rows
+
+        if workers == 1:
+            _init_worker(*initargs)
+            for pair in todo:
+                yield write(_sweep_one(pair))
+            return
+
+        pool = multiprocessing.Pool(
+            processes=workers, initializer=_init_worker, initargs=initargs
+        )
+        try:
+            for rows in pool.imap_unordered(_sweep_one, todo):
+                yield write(rows)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def read_pairs(path):
+    """
+    the rows of a CSV file with the columns q and k, as dicts
+    """
+    with open(path, "r", newline="") as f:
+        return [row for row in csv.DictReader(f)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="sweep the comparison parameters over a set of pairs"
+    )
+    parser.add_argument("pairs", help="CSV file with the columns q and k")
+    parser.add_argument("out", help="CSV file for the results, appended to")
+    parser.add_argument(
+        "--extractor",
+        nargs="+",
+        default=["ORB"],
+        choices=sorted(EXTRACTOR_MAP.keys()),
+    )
+    parser.add_argument("--epsilon", nargs="+", type=float, default=[0.5])
+    parser.add_argument("--alpha", nargs="+", type=float, default=[5.0])
+    parser.add_argument(
+        "--aligner", nargs="+", default=["kabsch"], choices=list(ALIGNER_MAP.keys())
+    )
+    parser.add_argument(
+        "--scorer",
+        nargs="+",
+        default=["all"],
+        choices=list(SCORINGMETHOD_MAP.keys()) + ["all"],
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--cache", default=None, help="directory for the keypoint store"
+    )
+    parser.add_argument(
+        "--cache-mb", type=float, default=1024, help="size limit of the store"
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=None,
+        help="seconds allowed for each clique search, keep the best so far",
+    )
+    args = parser.parse_args(argv)
+
+    metrics = "all" if "all" in args.scorer else args.scorer
+    grid = make_grid(args.extractor, args.epsilon, args.alpha, args.aligner, metrics)
+    pairs = [(x["q"], x["k"]) for x in read_pairs(args.pairs)]
+    cder_params = {}
+    if args.time_budget is not None:
+        cder_params["time_budget"] = args.time_budget
+    store = None
+    if args.cache:
+        store = KeypointStore(args.cache, max_bytes=args.cache_mb * (1 << 20))
+
+    for i, rows in enumerate(
+        sweep(pairs, grid, args.out, workers=args.workers, store=store, **cder_params)
+    ):
+        name = "%s %s" % (rows[0]["q_path"], rows[0]["k_path"]) if rows else ""
+        print("[%d] %s: %d rows" % (i + 1, name, len(rows)), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
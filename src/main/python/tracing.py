@@ -0,0 +1,217 @@
+"""
+per-stage tracing of a comparison.
+
+a Tracer records a span for every stage (load, extract, thin, graph,
+clique, fit, warp, score), with its duration on the monotonic clock,
+its memory, and whatever the stage adds to it: point counts, graph V/E, ...
+
+the memory fields are
+  * py_delta_mb, the Python heap (tracemalloc) at the end of the span
+    minus at its start,
+  * py_peak_mb, the peak Python heap during the span, on python 3.9+
+    only: older versions cannot reset the tracemalloc peak, so it would
+    be the peak since tracing started, and it is left out (None),
+  * rss_peak_mb, the peak resident set size of the whole process so far
+    (ru_maxrss), not of the span: it only says which span raised it.
+
+    tracer = Tracer("trace.jsonl", memory=True)
+    with tracer.span("extract", image="Q") as s:
+        ...
+        s["points"] = len(q.points)
+    tracer.close()
+
+the trace is a JSON-lines file, one line per span, in the order
+the spans finished. spans nest, and every record has its depth.
+NULL is a tracer that records nothing, for when tracing is off.
+
+listeners are called as listener(stage, phase, fields) when a span
+starts ("start") or ends ("end"), and for every event ("tick"),
+e.g. the heartbeats of the clique search. this is how the GUI and
+headless callers get their progress reports.
+
+set SHOECOMP_TRACE_DIR to trace every comparison of the GUI and the
+batch runner, and SHOECOMP_PROFILE=1 to also dump cProfile stats.
+"""
+__all__ = ("Tracer", "NullTracer", "NULL", "default_tracer")
+
+import os
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+# python 3.9+, see _peak_enter
+_HAS_RESET_PEAK = hasattr(tracemalloc, "reset_peak")
+
+
+def _rss_peak_mb():
+    # peak resident set size of the process, in MB
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024.0
+
+
+class NullTracer:
+    enabled = False
+
+    @contextmanager
+    def span(self, name, **fields):
+        yield fields
+
+    def event(self, name, **fields):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+NULL = NullTracer()
+
+
+class Tracer(NullTracer):
+    enabled = True
+
+    def __init__(
+        self, path=None, memory=True, profile=None, listeners=(), **meta
+    ):
+        """
+        path is the JSON-lines file written by close, or None to keep
+        the records in memory only. memory turns on tracemalloc, which
+        slows Python code down. profile is a path for cProfile stats.
+        meta goes into the first line of the trace.
+        """
+        self.path = path
+        self.memory = memory
+        self.listeners = list(listeners)
+        self.records = []
+        self.meta = dict(meta, wall_time=time.time())
+        self._t0 = time.perf_counter()
+        self._depth = 0
+        # peak of every open span, folded in before a nested span resets it
+        self._peaks = []
+        self._started_tracemalloc = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self.profile_path = profile
+        self._profiler = None
+        if profile is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def _peak_enter(self):
+        # the traced heap at the start of the span
+        if not self.memory:
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        if _HAS_RESET_PEAK:
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+        return current
+
+    def _peak_exit(self, start):
+        # (peak, delta) of the traced heap over the span, in MB
+        if not self.memory:
+            return None, None
+        current, peak = tracemalloc.get_traced_memory()
+        delta = (current - start) / (1 << 20)
+        if not _HAS_RESET_PEAK:
+            return None, delta
+        peak = max(peak, self._peaks.pop())
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        return peak / (1 << 20), delta
+
+    def _notify(self, stage, phase, fields):
+        for listener in self.listeners:
+            listener(stage, phase, fields)
+
+    @contextmanager
+    def span(self, name, **fields):
+        rec = dict(fields)
+        self._notify(name, "start", rec)
+        heap = self._peak_enter()
+        start = time.perf_counter()
+        self._depth += 1
+        try:
+            yield rec
+        except Exception as e:
+            rec["error"] = str(e)
+            raise
+        finally:
+            self._depth -= 1
+            duration = time.perf_counter() - start
+            py_peak_mb, py_delta_mb = self._peak_exit(heap)
+            rec.update(
+                stage=name,
+                depth=self._depth,
+                start=start - self._t0,
+                duration=duration,
+                py_peak_mb=py_peak_mb,
+                py_delta_mb=py_delta_mb,
+                rss_peak_mb=_rss_peak_mb(),
+            )
+            self.records.append(rec)
+            self._notify(name, "end", rec)
+
+    def event(self, name, **fields):
+        rec = dict(fields, stage=name, depth=self._depth)
+        rec["start"] = time.perf_counter() - self._t0
+        self.records.append(rec)
+        self._notify(name, "tick", rec)
+
+    def close(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            self._profiler = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                f.write(json.dumps(self.meta, default=str) + "\n")
+                for rec in self.records:
+                    f.write(json.dumps(rec, default=str) + "\n")
+
+
+def default_tracer(name, listener=None, **meta):
+    """
+    a Tracer writing to SHOECOMP_TRACE_DIR/<time>-<pid>-<name>.jsonl,
+    if SHOECOMP_TRACE_DIR is set. otherwise a Tracer that only calls
+    listener, without memory tracking, or NULL if there is no listener
+    """
+    listeners = [listener] if listener is not None else []
+    root = os.environ.get("SHOECOMP_TRACE_DIR")
+    if not root:
+        if listeners:
+            return Tracer(memory=False, listeners=listeners)
+        return NULL
+    os.makedirs(root, exist_ok=True)
+    stem = os.path.join(
+        root, "%s-%d-%s" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid(), name)
+    )
+    profile = None
+    if os.environ.get("SHOECOMP_PROFILE", "0") not in ("", "0"):
+        profile = stem + ".prof"
+    return Tracer(
+        stem + ".jsonl", profile=profile, listeners=listeners, name=name, **meta
+    )
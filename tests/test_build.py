@@ -0,0 +1,21 @@
+"""
+the frozen build only bundles what PyInstaller can see,
+and it cannot see the modules imported through _lazy.lazy_import
+"""
+import os
+import re
+import json
+import glob
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+
+
+def test_lazy_imports_are_hidden_imports():
+    with open(os.path.join(ROOT, "src", "build", "settings", "base.json")) as f:
+        hidden = set(json.load(f).get("hidden_imports", []))
+    lazy = set()
+    for path in glob.glob(os.path.join(ROOT, "src", "main", "python", "*.py")):
+        with open(path) as f:
+            lazy.update(re.findall(r"""lazy_import\(["']([\w.]+)["']\)""", f.read()))
+    assert lazy
+    assert lazy <= hidden, sorted(lazy - hidden)
@@ -0,0 +1,42 @@
+"""
+reference distributions from a checkpoint shared by several runs
+"""
+import csv
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from calibrate import collect  # noqa: E402
+from sweep import FIELDS, make_grid  # noqa: E402
+
+
+def test_collect_keeps_only_the_rows_of_the_grid(tmp_path):
+    path = str(tmp_path / "scores.csv")
+    labels = {("q1", "k1"): True, ("q2", "k2"): False}
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        # a run with epsilon 0.5, and a later one with epsilon 1
+        for eps, score in ((0.5, 0.9), (1.0, 0.1)):
+            for (q, k), mated in labels.items():
+                writer.writerow(
+                    dict(
+                        q_path=q,
+                        k_path=k,
+                        extractor="ORB",
+                        eps1=eps,
+                        alpha=5.0,
+                        alignment="kabsch",
+                        metric="clique_fraction",
+                        score=score if mated else score / 2,
+                        success=True,
+                    )
+                )
+
+    grid = make_grid(["ORB"], [0.5], [5.0], ["kabsch"], ["clique_fraction"])
+    dists = collect(path, labels, grid)
+    assert dists == {("ORB", "kabsch", "clique_fraction"): ([0.9], [0.45])}
+    # without a grid, both runs end up in one distribution
+    both = collect(path, labels)[("ORB", "kabsch", "clique_fraction")]
+    assert sorted(both[0]) == [0.1, 0.9]
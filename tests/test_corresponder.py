@@ -0,0 +1,181 @@
+"""
+the vectorized corresponders against the loops they replaced
+"""
+import itertools
+import math
+
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+
+import corresponder  # noqa: E402
+from corresponder import (  # noqa: E402
+    thin_indices,
+    limited_edges,
+    vertex_edges,
+    RansacMatcher,
+)
+from imdesc import ImageDesc  # noqa: E402
+
+
+def _rtree_thinning(pts, r):
+    # CliqueMatcherWithTuning._split before the KD-tree, as indices
+    rtree = pytest.importorskip("rtree")
+    is_pt = np.ones(len(pts), dtype=np.bool_)
+    ind = rtree.index.Index()
+    for i, p in enumerate(pts):
+        px, py = p
+        nearby = ind.intersection((px - r, py - r, px + r, py + r))
+        if any(np.linalg.norm(p - pts[j]) <= r for j in nearby):
+            is_pt[i] = False
+        else:
+            ind.insert(i, (px, py, px, py))
+    return np.nonzero(is_pt)[0]
+
+
+def _greedy_thinning(pts, r):
+    # the same loop with a brute-force search, for when rtree is missing
+    kept = []
+    for i, p in enumerate(pts):
+        if not any(np.linalg.norm(p - pts[j]) <= r for j in kept):
+            kept.append(i)
+    return np.array(kept, dtype=np.intp)
+
+
+def _point_sets():
+    rng = np.random.RandomState(0)
+    yield rng.rand(400, 2) * 200
+    # clusters, chains and exact distances, where the order matters
+    yield np.repeat(rng.rand(40, 2) * 100, 5, axis=0) + rng.rand(200, 2)
+    yield np.column_stack((np.arange(60) * 2.5, np.zeros(60)))
+    yield rng.randint(0, 30, size=(300, 2)).astype(np.float64)
+
+
+@pytest.mark.parametrize("reference", [_greedy_thinning, _rtree_thinning])
+@pytest.mark.parametrize("r", [0.0, 1.0, 2.5, 5.0, 12.0])
+def test_thin_indices_matches_the_old_thinning(reference, r):
+    for pts in _point_sets():
+        expected = np.arange(len(pts)) if r <= 0 else reference(pts, r)
+        np.testing.assert_array_equal(thin_indices(pts, r), expected)
+
+
+@pytest.mark.parametrize("rounds", [0, 1, 3])
+def test_thin_indices_sequential_fallback(monkeypatch, rounds):
+    monkeypatch.setattr(corresponder, "_THIN_ROUNDS", rounds)
+    for pts in _point_sets():
+        np.testing.assert_array_equal(
+            thin_indices(pts, 5.0), _greedy_thinning(pts, 5.0)
+        )
+
+
+def test_thin_indices_long_chain():
+    # one link per round: the rounds alone would take n of them
+    pts = np.column_stack((np.arange(20000) * 2.5, np.zeros(20000)))
+    np.testing.assert_array_equal(thin_indices(pts, 3.0), np.arange(0, 20000, 2))
+
+
+def _rigid_pair(seed, n=45, extra=15, theta=0.3, shift=(12.0, -7.0), noise=0.1):
+    """
+    Q points (row, col), and K points that the rotation by theta and the
+    shift take onto the first n of them; both have extra unmatched points
+    """
+    rng = np.random.RandomState(seed)
+    q_xy = rng.rand(n + extra, 2) * 300
+    c, s = math.cos(theta), math.sin(theta)
+    R = np.array([[c, -s], [s, c]])
+    # K = R^-1 (Q - shift), and the K-only points map far outside Q
+    k_xy = np.matmul(q_xy[:n] - shift, R) + rng.randn(n, 2) * noise
+    far = np.matmul(rng.rand(extra, 2) * 300 + 1000 - shift, R)
+    k_xy = np.concatenate((k_xy, far))[rng.permutation(n + extra)]
+    return q_xy[:, ::-1].copy(), k_xy[:, ::-1].copy(), R, np.array(shift)
+
+
+def _edge_ok(q1, q2, k1, k2, epsilon, theta_range, max_translation):
+    # the tests of limited_edges on one pair of vertices, (x, y) points
+    qd, kd = q2 - q1, k2 - k1
+    if not abs(math.hypot(*qd) - math.hypot(*kd)) < epsilon:
+        return False
+    theta = math.atan2(qd[1], qd[0]) - math.atan2(kd[1], kd[0])
+    if theta_range is not None:
+        lo, hi = math.radians(theta_range[0]), math.radians(theta_range[1])
+        off = (theta - (lo + hi) / 2 + math.pi) % (2 * math.pi) - math.pi
+        if abs(off) > (hi - lo) / 2:
+            return False
+    if max_translation is not None:
+        c, s = math.cos(theta), math.sin(theta)
+        t = q1 - np.array([c * k1[0] - s * k1[1], s * k1[0] + c * k1[1]])
+        if math.hypot(*t) > max_translation:
+            return False
+    return True
+
+
+LIMITS = [(None, None), ((-30, 30), None), (None, 40.0), ((0, 45), 40.0)]
+
+
+@pytest.mark.parametrize("theta_range, max_translation", LIMITS)
+def test_limited_edges_matches_brute_force(theta_range, max_translation):
+    Q_pts, K_pts, _, _ = _rigid_pair(1, n=14, extra=4)
+    Q_xy, K_xy = Q_pts[:, ::-1], K_pts[:, ::-1]
+    nk = len(K_pts)
+    expected = []
+    for qa, qb in itertools.combinations(range(len(Q_pts)), 2):
+        for ka, kb in itertools.permutations(range(nk), 2):
+            q1, q2, k1, k2 = Q_xy[qa], Q_xy[qb], K_xy[ka], K_xy[kb]
+            if _edge_ok(q1, q2, k1, k2, 1.0, theta_range, max_translation):
+                expected.append((qa * nk + ka + 1, qb * nk + kb + 1))
+    edges = limited_edges(
+        Q_pts, K_pts, 1.0, theta_range, max_translation, chunk_size=257
+    )
+    assert len(expected) > 0
+    assert sorted(map(tuple, edges.tolist())) == sorted(expected)
+
+
+@pytest.mark.parametrize("theta_range, max_translation", LIMITS)
+def test_vertex_edges_matches_brute_force(theta_range, max_translation):
+    Q_pts, K_pts, _, _ = _rigid_pair(2, n=14, extra=4)
+    Q_xy, K_xy = Q_pts[:, ::-1], K_pts[:, ::-1]
+    rng = np.random.RandomState(3)
+    vq = rng.randint(0, len(Q_pts), size=120)
+    vk = rng.randint(0, len(K_pts), size=120)
+    expected = []
+    for a, b in itertools.combinations(range(len(vq)), 2):
+        if vq[a] == vq[b] or vk[a] == vk[b]:
+            continue
+        if _edge_ok(
+            Q_xy[vq[a]],
+            Q_xy[vq[b]],
+            K_xy[vk[a]],
+            K_xy[vk[b]],
+            1.0,
+            theta_range,
+            max_translation,
+        ):
+            expected.append((a + 1, b + 1))
+    edges = vertex_edges(
+        Q_pts, K_pts, (vq, vk), 1.0, theta_range, max_translation, chunk_size=1000
+    )
+    assert len(expected) > 0
+    assert sorted(map(tuple, edges.tolist())) == sorted(expected)
+
+
+def _points(pts):
+    desc = ImageDesc(None)
+    desc.points = pts
+    return desc
+
+
+def test_ransac_is_repeatable_and_finds_the_rigid_motion():
+    Q_pts, K_pts, R, shift = _rigid_pair(4)
+    Q, K = _points(Q_pts), _points(K_pts)
+    matcher = RansacMatcher(epsilon=0.5, epsilon2=2.0, alpha=0.0, seed=7)
+    first, second = matcher(Q, K), matcher(Q, K)
+    assert first["success"]
+    np.testing.assert_array_equal(first["Q"], second["Q"])
+    np.testing.assert_array_equal(first["K"], second["K"])
+    assert first["hypotheses"] == second["hypotheses"]
+
+    # every matched point, and only those, is an inlier
+    assert first["size"] == 45
+    mapped = np.matmul(first["K"][:, ::-1], R.T) + shift
+    assert np.abs(mapped - first["Q"][:, ::-1]).max() < 1.0
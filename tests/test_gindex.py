@@ -0,0 +1,58 @@
+"""
+voting and persistence of the gallery index
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+
+import gindex  # noqa: E402
+from gindex import GalleryIndex, point_keys  # noqa: E402
+
+
+def _print(rng, n=150):
+    return rng.rand(n, 2) * 400
+
+
+def _index(all_keys, max_share):
+    index = GalleryIndex("ORB", max_share=max_share)
+    index.paths = ["k%d" % i for i in range(len(all_keys))]
+    ids = [np.full(len(x), i, dtype=np.int32) for i, x in enumerate(all_keys)]
+    keys, ids = np.concatenate(all_keys), np.concatenate(ids)
+    order = np.argsort(keys, kind="stable")
+    index.keys, index.ids = keys[order], ids[order]
+    index.n_keys = np.array([len(x) for x in all_keys], dtype=np.int64)
+    return index
+
+
+def test_common_keys_get_no_votes(monkeypatch):
+    rng = np.random.RandomState(0)
+    prints = [_print(rng) for _ in range(40)]
+    all_keys = [point_keys(x) for x in prints]
+    # a tread pattern that every print but the mate shares with Q
+    pattern = np.arange(10 ** 6, 10 ** 6 + 2000, dtype=np.int64)
+    q_keys = point_keys(prints[7])
+    for i in range(len(all_keys)):
+        if i != 7:
+            all_keys[i] = np.union1d(all_keys[i], pattern)
+
+    monkeypatch.setattr(
+        gindex, "point_keys", lambda *args: np.union1d(q_keys, pattern)
+    )
+    best = _index(all_keys, max_share=0.05).query(prints[7], top_n=1)
+    assert best[0][0] == "k7"
+    # without the stop-list, the pattern outvotes the mate
+    best = _index(all_keys, max_share=1.0).query(prints[7], top_n=1)
+    assert best[0][0] != "k7"
+
+
+def test_save_and_load_memory_maps(tmp_path):
+    rng = np.random.RandomState(1)
+    prints = [_print(rng) for _ in range(5)]
+    index = _index([point_keys(x) for x in prints], max_share=0.5)
+    index.save(str(tmp_path / "gallery"))
+    loaded = GalleryIndex.load(str(tmp_path / "gallery"))
+    assert isinstance(loaded.keys, np.memmap)
+    assert loaded.paths == index.paths and loaded.max_share == 0.5
+    np.testing.assert_array_equal(loaded.keys, index.keys)
+    assert loaded.query(prints[3], top_n=1)[0][0] == "k3"
@@ -0,0 +1,75 @@
+"""
+the reduced-resolution TIFF reader against imread + rescale + crop.
+set SHOECOMP_TEST_TIFF to a scan to also check it on that file.
+"""
+import os
+
+import numpy as np
+import pytest
+
+tifffile = pytest.importorskip("tifffile")
+skio = pytest.importorskip("skimage.io")
+sktrans = pytest.importorskip("skimage.transform")
+skutil = pytest.importorskip("skimage.util")
+
+from imdesc import _read_reduced_tiff  # noqa: E402
+
+CROP = ((20, 20), (20, 20))
+
+
+def _reference(path, scale, crop):
+    img = skio.imread(path, as_gray=True)
+    img = sktrans.rescale(img, scale, mode="symmetric", anti_aliasing=True)
+    return np.float32(skutil.crop(img, crop, copy=True, order="C"))
+
+
+def _print_like(shape, dtype, seed=0):
+    # smooth background, tread-like stripes and speckle, so that
+    # both the prefilter and the interpolation matter
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0 : shape[0], 0 : shape[1]]
+    img = 0.5 + 0.3 * np.sin(rows / 23.0) * np.cos(cols / 17.0)
+    img += 0.2 * ((rows // 9 + cols // 13) % 2)
+    img += 0.1 * rng.rand(*shape)
+    img = (img - img.min()) / (img.max() - img.min())
+    if np.issubdtype(dtype, np.integer):
+        return (img * np.iinfo(dtype).max).astype(dtype)
+    return img.astype(dtype)
+
+
+@pytest.mark.parametrize(
+    "shape, dtype, scale",
+    [
+        ((2406, 1207), np.uint8, 0.125),
+        ((2406, 1207), np.uint16, 0.125),
+        ((1501, 998), np.uint8, 0.25),
+        ((1501, 998), np.uint8, 0.3),
+        ((1200, 900, 3), np.uint8, 0.125),
+    ],
+)
+def test_reduced_tiff_matches_rescale(tmp_path, shape, dtype, scale):
+    path = str(tmp_path / "print.tif")
+    if len(shape) == 3:
+        img = np.stack(
+            [_print_like(shape[:2], dtype, seed=x) for x in range(shape[2])], -1
+        )
+        tifffile.imwrite(path, img, photometric="rgb", rowsperstrip=16)
+    else:
+        tifffile.imwrite(path, _print_like(shape, dtype), rowsperstrip=16)
+
+    expected = _reference(path, scale, CROP)
+    got = _read_reduced_tiff(path, scale, CROP)
+    assert got is not None
+    assert got.shape == expected.shape
+    np.testing.assert_allclose(got, expected, atol=1e-5)
+
+
+def test_reduced_tiff_matches_rescale_on_scan():
+    path = os.environ.get("SHOECOMP_TEST_TIFF")
+    if not path:
+        pytest.skip("SHOECOMP_TEST_TIFF is not set")
+    expected = _reference(path, 0.125, CROP)
+    got = _read_reduced_tiff(path, 0.125, CROP)
+    assert got is not None
+    assert got.shape == expected.shape
+    np.testing.assert_allclose(got, expected, atol=1e-5)
@@ -0,0 +1,74 @@
+"""
+the store shared by several writer processes, as in the batch pool
+"""
+import os
+import multiprocessing
+
+import numpy as np
+
+from kpstore import KeypointStore
+
+
+def _writer(args):
+    root, max_bytes, start = args
+    store = KeypointStore(root, max_bytes=max_bytes)
+    for i in range(start, start + 25):
+        store.put("%040x" % i, pts=np.full(256, i, dtype=np.float64))
+    return True
+
+
+def _run_writers(root, max_bytes, n=8):
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(n) as pool:
+        pool.map(_writer, [(root, max_bytes, 25 * x) for x in range(n)])
+    return KeypointStore(root, max_bytes=max_bytes)
+
+
+def test_concurrent_puts_are_all_kept(tmp_path):
+    store = _run_writers(str(tmp_path), max_bytes=1 << 30)
+    assert len(list(store._shards())) == 200
+    for i in range(200):
+        assert store.get("%040x" % i)["pts"][0] == i
+
+
+def test_concurrent_puts_stay_under_the_limit(tmp_path):
+    size = os.path.getsize(
+        _run_writers(str(tmp_path / "one"), 1 << 30, n=1)._shard_path("%040x" % 0)
+    )
+    store = _run_writers(str(tmp_path / "many"), max_bytes=50 * size)
+    # the last put of every writer evicts down to the limit
+    assert sum(x[1] for x in store._shards()) <= 50 * size
+
+
+def test_file_digest_follows_the_file(tmp_path):
+    path = str(tmp_path / "img.tif")
+    store = KeypointStore(str(tmp_path / "store"))
+    with open(path, "wb") as f:
+        f.write(b"one")
+    first = store.file_digest(path)
+    assert store.file_digest(path) == first
+    with open(path, "wb") as f:
+        f.write(b"two!")
+    assert store.file_digest(path) != first
+
+
+
+def test_array_hits_are_memory_mapped(tmp_path):
+    store = KeypointStore(str(tmp_path))
+    store.put_array("ab" * 20, np.arange(12, dtype=np.float32).reshape(3, 4))
+    arr = store.get_array("ab" * 20)
+    assert isinstance(arr, np.memmap)
+    assert not arr.flags.writeable
+    np.testing.assert_array_equal(arr, np.arange(12).reshape(3, 4))
+    assert store.get_array("cd" * 20) is None
+
+
+def test_array_shards_are_evicted(tmp_path):
+    store = KeypointStore(str(tmp_path), max_bytes=64 << 10)
+    for i in range(10):
+        store.put_array("%040x" % i, np.zeros(2048, dtype=np.float32))
+    assert sum(x[1] for x in store._shards()) <= 64 << 10
+    assert store.get_array("%040x" % 9) is not None
+    # too large for the store, not kept
+    store.put_array("ff" * 20, np.zeros(8192, dtype=np.float32))
+    assert store.get_array("ff" * 20) is None
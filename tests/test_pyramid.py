@@ -0,0 +1,89 @@
+"""
+coarse-to-fine matching against the single-scale clique
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("skimage")
+
+from scipy import ndimage  # noqa: E402
+from skimage import io as skio  # noqa: E402
+
+import pyramid  # noqa: E402
+from batch import compare_many  # noqa: E402
+from imdesc import ImageDesc  # noqa: E402
+from runner import extract_points, align_pair  # noqa: E402
+from extractor import EXTRACTOR_MAP  # noqa: E402
+
+
+def _texture(seed, shape=(2400, 3200)):
+    rng = np.random.RandomState(seed)
+    img = ndimage.gaussian_filter(rng.rand(*shape), 12)
+    img = (img - img.min()) / (img.max() - img.min())
+    return np.uint8(img * 255)
+
+
+def _write_pair(tmp_path):
+    q = _texture(0)
+    # K is Q turned by 6 degrees and shifted by (40, -24) pixels
+    k = ndimage.rotate(q, 6, reshape=False, mode="reflect")
+    k = ndimage.shift(k, (40, -24), mode="reflect")
+    q_path, k_path = str(tmp_path / "q.png"), str(tmp_path / "k.png")
+    skio.imsave(q_path, q, check_contrast=False)
+    skio.imsave(k_path, k, check_contrast=False)
+    return q_path, k_path
+
+
+def test_default_scales_end_finer_than_the_configured_scale():
+    base = pyramid._base_scale()
+    assert pyramid.default_scales() == (base / 2, base, 2 * base)
+    assert pyramid.default_scales(finest=base) == (base / 4, base / 2, base)
+
+
+def test_coarse_to_fine_agrees_with_the_single_scale_clique(tmp_path):
+    pytest.importorskip("cliquematch")
+    q_path, k_path = _write_pair(tmp_path)
+    base = pyramid._base_scale()
+
+    q = ImageDesc.from_file(q_path, is_k=False, is_match=True)
+    k = ImageDesc.from_file(k_path, is_k=True, is_match=True)
+    extractor = EXTRACTOR_MAP["ORB"]()
+    extract_points(extractor, q)
+    extract_points(extractor, k)
+    _, single_corr, single = align_pair(q, k, "kabsch", 0.5, 5.0)
+
+    *_, multi_corr, multi, levels = pyramid.align_multiscale(
+        q_path, k_path, "ORB", "kabsch", 0.5, 5.0, scales=(base / 4, base / 2, base)
+    )
+    assert single_corr["size"] >= 3 and multi_corr["size"] >= 3
+    assert [x["constrained"] for x in levels] == [False, True, True]
+    # the tolerance is that of the coarser fit, in the pixels of the level
+    assert levels[1]["tolerance"] == levels[2]["tolerance"] == 12.0
+    np.testing.assert_allclose(multi.params[:2, :2], single.params[:2, :2], atol=0.02)
+    np.testing.assert_allclose(multi.params[:2, 2], single.params[:2, 2], atol=2.0)
+
+
+def test_prescreen_keeps_the_best_candidates(tmp_path):
+    pytest.importorskip("cliquematch")
+    q_path, k_path = _write_pair(tmp_path)
+    other = str(tmp_path / "other.png")
+    skio.imsave(other, _texture(1), check_contrast=False)
+
+    results = list(
+        compare_many(
+            q_path,
+            [other, k_path],
+            "ORB",
+            "kabsch",
+            "clique_fraction",
+            0.5,
+            5.0,
+            workers=1,
+            prescreen=1,
+        )
+    )
+    by_path = {x["k_path"]: x for x in results}
+    assert by_path[k_path]["success"]
+    assert not by_path[other]["success"]
+    assert by_path[other]["message"] == "dropped by the prescreen"
+    assert by_path[k_path]["prescreen"] > by_path[other]["prescreen"]
@@ -0,0 +1,162 @@
+"""
+the cached and batched scorers against the formulas
+the reference distributions were computed with
+"""
+import os
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+pytest.importorskip("skimage")
+
+import scorer  # noqa: E402
+from imdesc import ImageDesc  # noqa: E402
+
+
+def _image(shape, seed):
+    rng = np.random.RandomState(seed)
+    return rng.rand(*shape).astype(np.float32)
+
+
+def _poc_reference(q, k):
+    # POC_R as it was when the reference distributions were made,
+    # numpy < 2 computed every FFT in float64
+    q, k = np.float64(q), np.float64(k)
+    freq_space = np.fft.fft2(q) * np.conj(np.fft.fft2(k))
+    freq_space = freq_space / np.abs(freq_space)
+    return np.max(np.fft.irfft2(freq_space))
+
+
+def test_poc_matches_reference():
+    k = ImageDesc(_image((96, 80), 0), name="k")
+    qs = [_image((96, 80), x) for x in range(1, 4)]
+    engine = scorer.POCEngine()
+    expected = [_poc_reference(q, k.img) for q in qs]
+    np.testing.assert_allclose(
+        [engine.score(q, k) for q in qs], expected, rtol=1e-9
+    )
+    np.testing.assert_allclose(engine.score_many(qs, k), expected, rtol=1e-9)
+
+
+def test_image_key_follows_the_file(tmp_path):
+    path = str(tmp_path / "k.tif")
+    with open(path, "wb") as f:
+        f.write(b"one")
+    desc = ImageDesc(_image((8, 8), 0), name="k", filename=path)
+    first = scorer._image_key(desc)
+    assert scorer._image_key(desc) == first
+    # edited in place, at the same path
+    with open(path, "wb") as f:
+        f.write(b"two!")
+    later = int((time.time() + 1) * 1e9)
+    os.utime(path, ns=(later, later))
+    assert scorer._image_key(desc) != first
+    assert scorer._image_key(ImageDesc(_image((8, 8), 0))) is None
+
+
+def _ncc_reference(q, k):
+    # NCC as it was when the reference distributions were made
+    def normalize(x):
+        std = np.std(x)
+        if std == 0:
+            return 0
+        return (x - np.mean(x)) / std
+
+    return np.mean(normalize(np.float64(q)) * normalize(np.float64(k)))
+
+
+def test_ncc_matches_reference():
+    k = ImageDesc(_image((96, 80), 0), name="k")
+    qs = [_image((96, 80), x) for x in range(1, 4)]
+    qs.append(np.ones((96, 80)))
+    qs.append(np.full((96, 80), 0.3, dtype=np.float32))
+    engine = scorer.NCCEngine()
+    expected = [_ncc_reference(q, k.img) for q in qs]
+    np.testing.assert_allclose(
+        engine.score_many(qs, k), expected, rtol=1e-9, atol=1e-12
+    )
+
+
+def test_spectrum_cache_is_bounded_by_bytes():
+    engine = scorer.POCEngine(max_bytes=3 * 96 * 80 * 16)
+    ks = [ImageDesc(_image((96, 80), x), name="k", key="k%d" % x) for x in range(5)]
+    for k in ks:
+        engine.spectrum(k)
+    assert len(engine.cache.data) == 3
+    assert engine.cache.nbytes <= engine.cache.max_bytes
+    engine.cache.limit(0)
+    assert not engine.cache.data
+    engine.spectrum(ks[0])
+    assert not engine.cache.data
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_match_points_matches_match_descriptors(seed):
+    skfeat = pytest.importorskip("skimage.feature")
+    spatial = pytest.importorskip("scipy.spatial")
+    rng = np.random.RandomState(seed)
+    # on a coarse grid, so that there are ties in the distances
+    Q_pts = rng.randint(0, 40, size=(300, 2)).astype(np.float64)
+    K_pts = Q_pts[rng.permutation(300)[:200]] + rng.randint(-2, 3, size=(200, 2))
+    K_pts = np.vstack([K_pts, rng.randint(0, 40, size=(50, 2))])
+    for max_distance in (1.0, 2.5, 5.0, np.inf):
+        expected = skfeat.match_descriptors(
+            Q_pts,
+            K_pts,
+            metric="euclidean",
+            max_distance=max_distance,
+            cross_check=True,
+        )
+        got = scorer.match_points(
+            spatial.cKDTree(Q_pts), Q_pts, K_pts, max_distance
+        )
+        np.testing.assert_array_equal(got, expected)
+
+
+def test_median_distance_score_many_shares_one_tree(monkeypatch):
+    rng = np.random.RandomState(0)
+    q = ImageDesc(None, name="q")
+    q.points = rng.rand(100, 2) * 200
+    ks = []
+    for x in range(4):
+        k = ImageDesc(None, name="k%d" % x)
+        k.points = q.points[:90] + rng.randn(90, 2)
+        ks.append(k)
+    funcs = [lambda pts: pts] * len(ks)
+    expected = [scorer.MedianDistance(q, k, None, f, 5)() for k, f in zip(ks, funcs)]
+
+    built = []
+    cKDTree = scorer.spatial.cKDTree
+
+    def counting(pts, *args, **kwargs):
+        built.append(len(pts))
+        return cKDTree(pts, *args, **kwargs)
+
+    monkeypatch.setattr(scorer.spatial, "cKDTree", counting)
+    got = scorer.MedianDistance.score_many(q, ks, funcs, 5)
+    np.testing.assert_allclose(got, expected)
+    # one tree over Q for all the Ks, and one per K inside match_points
+    assert built.count(len(q.points)) == 1
+    assert built.count(90) == len(ks)
+
+
+def test_match_points_breaks_ties_beyond_four_neighbours():
+    skfeat = pytest.importorskip("skimage.feature")
+    spatial = pytest.importorskip("scipy.spatial")
+    # every K point has 8 Q points at the same distance, listed in an
+    # order that the KD-tree does not keep
+    offsets = np.array(
+        [[2, 1], [1, 2], [-1, 2], [-2, 1], [-2, -1], [-1, -2], [1, -2], [2, -1]]
+    )
+    K_pts = np.array([[10.0, 10.0], [30.0, 10.0], [10.0, 30.0]])
+    Q_pts = np.vstack([k + offsets[::-1] for k in K_pts] + [[[50.0, 50.0]]])
+    rng = np.random.RandomState(0)
+    Q_pts = Q_pts[rng.permutation(len(Q_pts))]
+    expected = skfeat.match_descriptors(
+        Q_pts, K_pts, metric="euclidean", max_distance=5.0, cross_check=True
+    )
+    got = scorer.match_points(spatial.cKDTree(Q_pts), Q_pts, K_pts, 5.0)
+    assert len(expected) == 3
+    np.testing.assert_array_equal(got, expected)
@@ -0,0 +1,62 @@
+"""
+resuming a sweep from a checkpoint cut short mid-row
+"""
+import csv
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import sweep  # noqa: E402
+from sweep import FIELDS, make_grid  # noqa: E402
+
+
+def _row(q, k):
+    return dict(
+        q_path=q,
+        k_path=k,
+        extractor="ORB",
+        eps1=0.5,
+        alpha=5.0,
+        alignment="kabsch",
+        metric="clique_fraction",
+        score=0.5,
+        success=True,
+    )
+
+
+def _write_checkpoint(path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerow(_row("q1", "k1"))
+        complete = f.tell()
+        writer.writerow(_row("q2", "k2"))
+    # killed while writing the second row
+    with open(path, "r+b") as f:
+        f.truncate(complete + 12)
+    return complete
+
+
+@pytest.mark.parametrize("chunk", [4, 1 << 16])
+def test_drop_partial_row(tmp_path, chunk):
+    path = str(tmp_path / "scores.csv")
+    complete = _write_checkpoint(path)
+    sweep._drop_partial_row(path, chunk=chunk)
+    with open(path, "rb") as f:
+        assert len(f.read()) == complete
+    # a complete file is left alone
+    sweep._drop_partial_row(path, chunk=chunk)
+    with open(path, "rb") as f:
+        assert len(f.read()) == complete
+
+
+def test_sweep_repairs_the_checkpoint(tmp_path):
+    path = str(tmp_path / "scores.csv")
+    _write_checkpoint(path)
+    grid = make_grid(["ORB"], [0.5], [5.0], ["kabsch"], ["clique_fraction"])
+    # q1/k1 is done, so nothing is computed, but the cut row is gone
+    assert list(sweep.sweep([("q1", "k1")], grid, path, workers=1)) == []
+    with open(path, "r", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [(x["q_path"], x["k_path"]) for x in rows] == [("q1", "k1")]